@@ -0,0 +1,137 @@
+import asyncio
+import random
+import secrets
+from collections import Counter
+from typing import Optional, Callable, Awaitable
+from urllib.parse import urlsplit
+
+from aiohttp import web
+
+from bot.constants import ApiURL
+
+TWO_FA_REQUIRED_MESSAGE = 'Two factor authentication code is required'
+
+
+class FakeKcashServer:
+    """Local stand-in for kcash API serving every ApiURL endpoint with given latency.
+    Sign in may require 2FA code (error 126), access tokens may expire (error 171)
+    and tokens refresh may fail with given rates"""
+
+    def __init__(
+            self,
+            latency: float = 0.05,
+            latency_jitter: float = 0.02,
+            two_fa_rate: float = 0,
+            token_expiration_rate: float = 0,
+            refresh_failure_rate: float = 0,
+            seed: Optional[int] = None,
+    ):
+        self._latency = latency
+        self._latency_jitter = latency_jitter
+        self._two_fa_rate = two_fa_rate
+        self._token_expiration_rate = token_expiration_rate
+        self._refresh_failure_rate = refresh_failure_rate
+        self._random = random.Random(seed)
+        self._access_tokens: dict[str, str] = {}  # Access token to login
+        self._refresh_tokens: dict[str, str] = {}  # Refresh token to login
+        self.requests = Counter()
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str, port: int):
+        handlers: dict[ApiURL, Callable[[web.Request], Awaitable[web.Response]]] = {
+            ApiURL.LOG_IN: self._sign_in,
+            ApiURL.REGISTER: self._sign_in,
+            ApiURL.LOG_OUT: self._logout,
+            ApiURL.LOG_OUT_FROM_ALL: self._logout,
+            ApiURL.ENABLE_2FA: self._process_authorized_action,
+            ApiURL.DISABLE_2FA: self._process_authorized_action,
+            ApiURL.MANAGE_2FA: self._process_authorized_action,
+            ApiURL.CHANGE_PASSWORD: self._process_authorized_action,
+            ApiURL.SETUP_2FA: self._setup_2fa,
+            ApiURL.CHECK_BALANCE: self._get_user_wallets,
+            ApiURL.ACCOUNT_INFO: self._get_current_customer,
+            ApiURL.REFRESH_TOKEN: self._refresh_token,
+        }
+        app = web.Application(middlewares=[self._simulate_latency])
+        for url, handler in handlers.items():
+            app.router.add_route('*', urlsplit(url.value).path, handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @web.middleware
+    async def _simulate_latency(self, request: web.Request, handler) -> web.Response:
+        self.requests[request.path.rsplit('/', 1)[-1]] += 1
+        await asyncio.sleep(max(0.0, self._random.gauss(self._latency, self._latency_jitter)))
+        return await handler(request)
+
+    async def _sign_in(self, request: web.Request) -> web.Response:
+        user_data = await request.json()
+        if not user_data.get('twoFaPin') and self._random.random() < self._two_fa_rate:
+            return self._error(126, TWO_FA_REQUIRED_MESSAGE)
+        return web.json_response(self._issue_tokens(user_data.get('login') or user_data.get('email')))
+
+    async def _logout(self, request: web.Request) -> web.Response:
+        login = self._authorize(request)
+        if login is None:
+            return self._error(171, 'Access token is expired')
+        self._access_tokens.pop(request.headers['authorization-vbtc'])
+        return web.Response()
+
+    async def _process_authorized_action(self, request: web.Request) -> web.Response:
+        if self._authorize(request) is None:
+            return self._error(171, 'Access token is expired')
+        return web.Response()
+
+    async def _setup_2fa(self, request: web.Request) -> web.Response:
+        login = self._authorize(request)
+        if login is None:
+            return self._error(171, 'Access token is expired')
+        return web.json_response({
+            'manualEntryKey': secrets.token_hex(8),
+            'account': login,
+            'qrCodeSetupImageUrl': 'https://example.com/qr.png',
+        })
+
+    async def _get_user_wallets(self, request: web.Request) -> web.Response:
+        if self._authorize(request) is None:
+            return self._error(171, 'Access token is expired')
+        return web.json_response({'wallets': [
+            {'currencyName': 'BTC', 'availableFunds': 0.5},
+            {'currencyName': 'ETH', 'availableFunds': 12.25},
+            {'currencyName': 'USDT', 'availableFunds': 1000},
+        ]})
+
+    async def _get_current_customer(self, request: web.Request) -> web.Response:
+        login = self._authorize(request)
+        if login is None:
+            return self._error(171, 'Access token is expired')
+        return web.json_response({'userName': login})
+
+    async def _refresh_token(self, request: web.Request) -> web.Response:
+        login = self._refresh_tokens.pop(request.query.get('RefreshToken', ''), None)
+        if login is None or self._random.random() < self._refresh_failure_rate:
+            return self._error(172, 'Refresh token is invalid')
+        self._access_tokens.pop(request.headers.get('authorization-vbtc', ''), None)
+        return web.json_response(self._issue_tokens(login))
+
+    def _authorize(self, request: web.Request) -> Optional[str]:
+        """Get login of user whose access token is passed, token may be expired at random"""
+        access_token = request.headers.get('authorization-vbtc', '')
+        if self._random.random() < self._token_expiration_rate:
+            self._access_tokens.pop(access_token, None)
+        return self._access_tokens.get(access_token)
+
+    def _issue_tokens(self, login: str) -> dict[str, str]:
+        access_token, refresh_token = secrets.token_hex(16), secrets.token_hex(16)
+        self._access_tokens[access_token] = login
+        self._refresh_tokens[refresh_token] = login
+        return {'accessToken': access_token, 'refreshToken': refresh_token}
+
+    @staticmethod
+    def _error(code: int, message: str) -> web.Response:
+        return web.json_response({'error': {'messageCode': code, 'message': message}}, status=400)
@@ -0,0 +1,117 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from typing import Optional
+
+import ujson
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bot'}
+
+
+class FakeTelegramServer:
+    """Local stand-in for Telegram Bot API serving updates of simulated users by getUpdates
+    and delivering messages sent by bot to them"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._updates: deque[dict] = deque()
+        self._new_updates = asyncio.Event()
+        self._replies: dict[int, asyncio.Queue] = {}
+        self.sent_messages = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str, port: int):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._process_method)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def send_message(self, user_id: int, text: str):
+        """Add update with message sent by user"""
+        message = self._create_message(user_id, text, self._create_user(user_id))
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self._add_update(message=message)
+
+    def press_button(self, user_id: int, callback_data: str):
+        """Add update with callback query of inline keyboard button pressed by user"""
+        self._add_update(callback_query={
+            'id': str(next(self._message_ids)),
+            'from': self._create_user(user_id),
+            'chat_instance': str(user_id),
+            'message': self._create_message(user_id, '', BOT_USER),
+            'data': callback_data,
+        })
+
+    async def get_reply(self, user_id: int) -> dict:
+        """Wait for the next message sent by bot to user"""
+        return await self._get_replies(user_id).get()
+
+    def _add_update(self, **update):
+        self._updates.append({'update_id': next(self._update_ids), **update})
+        self._new_updates.set()
+
+    def _get_replies(self, chat_id: int) -> asyncio.Queue:
+        replies = self._replies.get(chat_id)
+        if replies is None:
+            replies = self._replies[chat_id] = asyncio.Queue()
+        return replies
+
+    async def _process_method(self, request: web.Request) -> web.Response:
+        params = await request.post()
+        method = request.match_info['method'].lower()
+        if method == 'getupdates':
+            result = await self._get_updates(
+                offset=int(params.get('offset', 0)),
+                limit=int(params.get('limit', 100)),
+                timeout=float(params.get('timeout', 0)),
+            )
+        elif method == 'sendmessage':
+            result = self._deliver_message(
+                int(params['chat_id']),
+                params['text'],
+                ujson.loads(params['reply_markup']) if 'reply_markup' in params else None,
+            )
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result}, dumps=ujson.dumps)
+
+    async def _get_updates(self, offset: int, limit: int, timeout: float) -> list[dict]:
+        """Confirm updates before offset and wait for new ones up to timeout"""
+        if offset < 0:
+            return list(self._updates)[offset:]
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        return list(itertools.islice(self._updates, limit))
+
+    def _deliver_message(self, chat_id: int, text: str, reply_markup: Optional[dict]) -> dict:
+        self.sent_messages += 1
+        self._get_replies(chat_id).put_nowait({'text': text, 'reply_markup': reply_markup})
+        return self._create_message(chat_id, text, BOT_USER)
+
+    def _create_message(self, chat_id: int, text: str, from_user: dict) -> dict:
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': from_user,
+            'text': text,
+        }
+
+    @staticmethod
+    def _create_user(user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
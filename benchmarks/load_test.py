@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import resource
+import time
+from collections import defaultdict, Counter
+from typing import Callable
+
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
+
+from benchmarks.fake_kcash import FakeKcashServer, TWO_FA_REQUIRED_MESSAGE
+from benchmarks.fake_telegram import FakeTelegramServer
+from bot.constants import Codes
+from bot.app import create_dispatcher, on_startup, on_shutdown
+from bot.polling import GracefulPolling, POLLING_OFFSET_KEY
+from project_settings import settings
+
+ERROR_REPLIES = ('Error occurred', 'Something is wrong')
+
+
+class FlowError(Exception):
+
+    def __init__(self, step: str, reason: str):
+        self.step = step
+        self.reason = reason
+        super(FlowError, self).__init__(step, reason)
+
+
+def get_callback_data(reply: dict) -> set[str]:
+    """Get callback data of all inline keyboard buttons of the reply"""
+    keyboard = (reply['reply_markup'] or {}).get('inline_keyboard', [])
+    return {button.get('callback_data') for row in keyboard for button in row}
+
+
+def is_start_page(reply: dict) -> bool:
+    return Codes.SIGN_IN_USER.value in get_callback_data(reply)
+
+
+def is_main_menu(reply: dict) -> bool:
+    return Codes.LOG_OUT_FROM_CURRENT_DEVICE.value in get_callback_data(reply)
+
+
+def starts_with(text: str) -> Callable[[dict], bool]:
+    return lambda reply: reply['text'].startswith(text)
+
+
+def get_percentile(values: list[float], share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class LoadTest:
+    """Drive simulated users through sign in, main menu, 2FA setup and logout
+    measuring time from every update till the bot reply expected at this step"""
+
+    def __init__(self, telegram: FakeTelegramServer, step_timeout: float):
+        self._telegram = telegram
+        self._step_timeout = step_timeout
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.failures = Counter()
+        self.completed_flows = 0
+        self.updates = 0
+
+    async def run(self, users: int, concurrency: int):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_user(user_id: int):
+            async with semaphore:
+                try:
+                    await self._run_user_flow(user_id)
+                    self.completed_flows += 1
+                except FlowError as error:
+                    self.failures[(error.step, error.reason)] += 1
+
+        await asyncio.gather(*(run_user(user_id) for user_id in range(1, users + 1)))
+
+    async def _run_user_flow(self, user_id: int):
+        telegram = self._telegram
+        await self._step('start', user_id, lambda: telegram.send_message(user_id, '/start'), is_start_page)
+        await self._step(
+            'sign_in',
+            user_id,
+            lambda: telegram.press_button(user_id, Codes.SIGN_IN_USER.value),
+            starts_with('Type your email'),
+        )
+        await self._step(
+            'login',
+            user_id,
+            lambda: telegram.send_message(user_id, f'user{user_id}@example.com'),
+            starts_with('Type your password'),
+        )
+        await self._step(
+            'password',
+            user_id,
+            lambda: telegram.send_message(user_id, 'password'),
+            starts_with('Type your capcha'),
+        )
+        reply = await self._step(
+            'capcha',
+            user_id,
+            lambda: telegram.send_message(user_id, 'capcha'),
+            lambda sent_reply: is_main_menu(sent_reply) or sent_reply['text'] == TWO_FA_REQUIRED_MESSAGE,
+        )
+        if not is_main_menu(reply):
+            await self._step('sign_in_2fa', user_id, lambda: telegram.send_message(user_id, '123456'), is_main_menu)
+        await self._step(
+            'setup_2fa',
+            user_id,
+            lambda: telegram.press_button(user_id, Codes.ENABLE_2FA.value),
+            starts_with('Use manual key'),
+        )
+        await self._step('enable_2fa', user_id, lambda: telegram.send_message(user_id, '123456'), is_main_menu)
+        await self._step(
+            'logout',
+            user_id,
+            lambda: telegram.press_button(user_id, Codes.LOG_OUT_FROM_CURRENT_DEVICE.value),
+            is_start_page,
+        )
+
+    async def _step(
+            self,
+            name: str,
+            user_id: int,
+            send_update: Callable[[], None],
+            is_expected_reply: Callable[[dict], bool],
+    ) -> dict:
+        """Send update and wait for the expected reply skipping intermediate ones"""
+        started_at = time.perf_counter()
+        send_update()
+        self.updates += 1
+        while True:
+            try:
+                reply = await asyncio.wait_for(
+                    self._telegram.get_reply(user_id),
+                    started_at + self._step_timeout - time.perf_counter(),
+                )
+            except asyncio.TimeoutError:
+                raise FlowError(name, 'timeout')
+            if reply['text'].startswith(ERROR_REPLIES):
+                raise FlowError(name, reply['text'].split('\n', 1)[0][:80])
+            if is_expected_reply(reply):
+                self.latencies[name].append(time.perf_counter() - started_at)
+                return reply
+
+
+async def use_fakeredis(storage: RedisStorage2):
+    """Replace redis connection of storage with in-process fakeredis"""
+    from fakeredis.aioredis import FakeRedis
+
+    adapter = await storage._get_adapter()
+    adapter._redis = FakeRedis(decode_responses=True)
+
+
+async def run_load_test(args: argparse.Namespace) -> dict:
+    """Run the bot against fake Telegram Bot API and kcash API and get results"""
+    telegram = FakeTelegramServer()
+    kcash = FakeKcashServer(
+        latency=args.kcash_latency,
+        latency_jitter=args.kcash_latency_jitter,
+        two_fa_rate=args.two_fa_rate,
+        token_expiration_rate=args.token_expiration_rate,
+        refresh_failure_rate=args.refresh_failure_rate,
+        seed=args.seed,
+    )
+    await telegram.start(args.host, args.telegram_port)
+    await kcash.start(args.host, args.kcash_port)
+    dp = create_dispatcher()
+    if args.fakeredis:
+        await use_fakeredis(dp.storage)
+    redis = await dp.storage.redis()
+    await redis.set(POLLING_OFFSET_KEY, 1)  # Fake Telegram API numbers updates from 1 on every run
+    await on_startup(dp)
+    polling = GracefulPolling(dp, timeout=settings.polling.timeout)
+    polling_task = asyncio.create_task(polling.run())
+
+    load_test = LoadTest(telegram, args.step_timeout)
+    started_at = time.perf_counter()
+    try:
+        await load_test.run(args.users, args.concurrency)
+    finally:
+        duration = time.perf_counter() - started_at
+        polling_task.cancel()
+        await asyncio.gather(polling_task, return_exceptions=True)
+        await polling.drain(settings.polling.drain_timeout)
+        await on_shutdown(dp)
+        await dp.bot.session.close()
+        await kcash.stop()
+        await telegram.stop()
+
+    return {
+        'users': args.users,
+        'completed_flows': load_test.completed_flows,
+        'updates': load_test.updates,
+        'duration': duration,
+        'updates_per_second': load_test.updates / duration,
+        'bot_messages': telegram.sent_messages,
+        'kcash_requests': dict(kcash.requests),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'steps': {
+            step: {
+                'count': len(latencies),
+                'p50': get_percentile(latencies, 0.5),
+                'p95': get_percentile(latencies, 0.95),
+                'p99': get_percentile(latencies, 0.99),
+                'max': max(latencies),
+            }
+            for step, latencies in load_test.latencies.items()
+        },
+        'failures': [
+            {'step': step, 'reason': reason, 'count': count}
+            for (step, reason), count in load_test.failures.most_common()
+        ],
+    }
+
+
+def format_results(results: dict) -> str:
+    lines = [
+        f'Users: {results["users"]}, completed flows: {results["completed_flows"]}',
+        f'Updates: {results["updates"]} in {results["duration"]:.2f}s, '
+        f'{results["updates_per_second"]:.1f} updates/sec',
+        f'Bot messages: {results["bot_messages"]}, kcash requests: {sum(results["kcash_requests"].values())}',
+        f'Peak RSS: {results["peak_rss_mb"]:.1f} MB',
+        '',
+        f'{"step":<12}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}',
+    ]
+    for step, stats in results['steps'].items():
+        lines.append(
+            f'{step:<12}{stats["count"]:>8}' +
+            ''.join(f'{stats[key] * 1000:>10.1f}' for key in ('p50', 'p95', 'p99', 'max'))
+        )
+    if results['failures']:
+        lines.extend(('', 'Failures:'))
+        lines.extend(f'{failure["step"]}: {failure["reason"]} x{failure["count"]}' for failure in results['failures'])
+    return '\n'.join(lines)
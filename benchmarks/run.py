@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import os
+import pathlib
+import tempfile
+
+import ujson
+
+from benchmarks.load_test import run_load_test, format_results
+from bot.log_config import setup_logging
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Load test the bot against local fake Telegram and kcash APIs')
+    parser.add_argument('--users', type=int, default=1000, help='Number of simulated users')
+    parser.add_argument('--concurrency', type=int, default=200, help='Number of users going through flow at once')
+    parser.add_argument('--step-timeout', type=float, default=10, help='Time to wait for bot reply at every step')
+    parser.add_argument('--kcash-latency', type=float, default=0.05, help='Mean latency of kcash API responses')
+    parser.add_argument('--kcash-latency-jitter', type=float, default=0.02)
+    parser.add_argument('--two-fa-rate', type=float, default=0.2, help='Share of sign ins requiring 2FA code')
+    parser.add_argument('--token-expiration-rate', type=float, default=0.05, help='Share of expired access tokens')
+    parser.add_argument('--refresh-failure-rate', type=float, default=0, help='Share of failed tokens refreshes')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    parser.add_argument('--kcash-port', type=int, default=8082)
+    parser.add_argument('--fakeredis', action='store_true', help='Use in-process fakeredis instead of redis server')
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-password', default='')
+    parser.add_argument('--config', type=pathlib.Path, help='Bot config to take the rest of settings from')
+    parser.add_argument('--telegram-limits', action='store_true', help='Keep outgoing messages flood limits')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', type=pathlib.Path, help='Save results as json to compare runs')
+    return parser.parse_args()
+
+
+def create_config(args: argparse.Namespace) -> dict:
+    """Create bot config pointing it at fake APIs"""
+    config = ujson.load(args.config.open('r')) if args.config is not None else {}
+    config.update(
+        token='123456:benchmark',
+        redis_password=args.redis_password,
+        redis_host=args.redis_host,
+        telegram_api_url=f'http://{args.host}:{args.telegram_port}',
+    )
+    config['api_client'] = {**config.get('api_client', {}), 'base_url': f'http://{args.host}:{args.kcash_port}'}
+    config['logging'] = {**config.get('logging', {}), 'level': args.log_level, 'sink': None}
+    if not args.telegram_limits:  # Fake Telegram API has no flood limits
+        config['sender'] = {
+            **config.get('sender', {}),
+            'global_rate': 10 ** 6,
+            'chat_rate': 10 ** 6,
+            'chat_burst': 10 ** 6,
+        }
+    return config
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as config_dir:
+        config_path = pathlib.Path(config_dir) / 'config.json'
+        config_path.write_text(ujson.dumps(create_config(args)))
+        os.environ['BOT_CONFIG_PATH'] = str(config_path)
+
+        setup_logging()
+        results = asyncio.run(run_load_test(args))
+
+    print(format_results(results))
+    if args.output is not None:
+        args.output.write_text(ujson.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import asyncio
+import heapq
+import itertools
+from typing import Optional
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from bot.constants import Codes
+from bot.metrics import rejected_updates
+from bot.sender import message_sender
+from bot.workers import UserLocks, get_update_user_id
+
+OVERFLOW_TEXT = 'Bot is overloaded, try again in a minute'
+CHEAP_PRIORITY, EXPENSIVE_PRIORITY = 0, 1
+PROMPT_CALLBACKS = frozenset((  # Callbacks only showing menu or prompt without kcash API calls
+    Codes.SIGN_IN_USER.value,
+    Codes.REGISTER_USER.value,
+    Codes.PASSWORD_CHANGE.value,
+    Codes.DISABLE_2FA.value,
+    'Get back to the main page',
+))
+
+
+def get_update_priority(update: types.Update) -> int:
+    """Commands and menu buttons are cheap, data submissions and actions calling kcash API are expensive"""
+    if update.message is not None and update.message.is_command():
+        return CHEAP_PRIORITY
+    if update.callback_query is not None and update.callback_query.data in PROMPT_CALLBACKS:
+        return CHEAP_PRIORITY
+    return EXPENSIVE_PRIORITY
+
+
+class PrioritySemaphore:
+    """Semaphore letting waiters with lower priority value in first"""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: int):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():  # Permit was passed right before cancellation
+                self.release()
+            raise
+
+    def release(self):
+        """Pass permit to the first waiter or return it, cancelled waiters are skipped"""
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._value += 1
+
+
+class AdmissionControlMiddleware(BaseMiddleware):
+    """Limit number of updates processed at once and process updates of every user one by one.
+    Updates waiting for their turn are bounded, the ones over the bound are rejected with a reply.
+    Cheap updates are let in before expensive ones"""
+
+    def __init__(self, max_in_flight: int, queue_size: int):
+        self._slots = PrioritySemaphore(max_in_flight)
+        self._queue_size = queue_size
+        self._waiting = 0
+        self._user_locks = UserLocks()
+        super(AdmissionControlMiddleware, self).__init__()
+
+    def waiting(self) -> int:
+        return self._waiting
+
+    async def on_process_update(self, update: types.Update, data: dict):
+        if self._waiting >= self._queue_size:
+            rejected_updates.inc()
+            await self._reply_overflow(update)
+            raise CancelHandler()
+        user_id = get_update_user_id(update)
+        self._waiting += 1
+        try:
+            await self._admit(user_id, get_update_priority(update))
+        finally:
+            self._waiting -= 1
+        data['admitted_user_id'] = user_id
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        if 'admitted_user_id' in data:
+            self._slots.release()
+            self._release_user(data['admitted_user_id'])
+
+    async def _admit(self, user_id: Optional[int], priority: int):
+        """Wait until the previous update of user is processed and a slot is free"""
+        if user_id is not None:
+            await self._user_locks.acquire(user_id)
+        try:
+            await self._slots.acquire(priority)
+        except asyncio.CancelledError:
+            self._release_user(user_id)
+            raise
+
+    def _release_user(self, user_id: Optional[int]):
+        if user_id is not None:
+            self._user_locks.release(user_id)
+
+    @staticmethod
+    async def _reply_overflow(update: types.Update):
+        if update.callback_query is not None:
+            await update.callback_query.answer(OVERFLOW_TEXT)
+        elif update.message is not None:
+            await message_sender.send(update.message.chat.id, OVERFLOW_TEXT)
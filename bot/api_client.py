@@ -0,0 +1,179 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, AsyncIterator, AsyncContextManager
+from urllib.parse import urlsplit
+
+import ujson
+from aiohttp import ClientSession, TCPConnector, ClientTimeout, ClientResponse, ClientError
+
+from bot.constants import ApiURL
+from bot.exceptions import UpstreamUnavailableError
+from bot.metrics import api_request_latency
+from bot.tracing import tracer
+from project_settings import settings
+
+IDEMPOTENT_URLS = frozenset((ApiURL.CHECK_BALANCE.value, ApiURL.ACCOUNT_INFO.value))
+SLOW_URLS = frozenset((ApiURL.LOG_IN.value, ApiURL.REGISTER.value, ApiURL.CHANGE_PASSWORD.value))
+ENDPOINT_NAMES = {url.value: url.name for url in ApiURL}
+
+
+class CircuitBreaker:
+    """Stop sending requests to upstream after several failures in a row,
+    while it is open let one trial request through every recovery timeout"""
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout = recovery_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def check(self):
+        """Raise error if requests are not allowed now"""
+        if self._opened_at is None:
+            return
+        now = time.monotonic()
+        if now - self._opened_at < self._recovery_timeout:
+            raise UpstreamUnavailableError('Service is temporarily unavailable, try again later', 503)
+        self._opened_at = now  # Current request is a trial one
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self._opened_at is not None or self._failures >= self._failure_threshold:
+            self._opened_at = time.monotonic()
+
+
+class KcashApiClient:
+    """Long-lived HTTP client sharing one pooled connector between all kcash API requests.
+    Every request is made with timeouts of its endpoint, idempotent requests are retried
+    and circuit breaker fails requests fast while upstream is down"""
+
+    def __init__(self):
+        self._session: Optional[ClientSession] = None
+        self._urls: dict[str, str] = {}
+        self._default_timeout = ClientTimeout()
+        self._timeouts: dict[str, ClientTimeout] = {}
+        self.circuit_breaker: Optional[CircuitBreaker] = None
+
+    @property
+    def session(self) -> ClientSession:
+        """Get opened client session"""
+        if self._session is None or self._session.closed:
+            raise RuntimeError('Kcash API client is not started')
+        return self._session
+
+    async def start(self):
+        """Open client session with pooled connections, timeouts and circuit breaker tuned by settings"""
+        if self._session is not None and not self._session.closed:
+            return
+        api_client_settings = settings.api_client
+        self._urls = {url.value: api_client_settings.base_url.rstrip('/') + urlsplit(url.value).path for url in ApiURL}
+        self._default_timeout = ClientTimeout(
+            sock_connect=api_client_settings.connect_timeout,
+            sock_read=api_client_settings.read_timeout,
+        )
+        self._timeouts = self._create_endpoints_timeouts()
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=api_client_settings.failure_threshold,
+            recovery_timeout=api_client_settings.recovery_timeout,
+        )
+        connector = TCPConnector(
+            limit=api_client_settings.connections_limit,
+            limit_per_host=api_client_settings.connections_limit_per_host,
+            keepalive_timeout=api_client_settings.keepalive_timeout,
+            ttl_dns_cache=api_client_settings.dns_cache_ttl,
+            use_dns_cache=True,
+        )
+        self._session = ClientSession(connector=connector, json_serialize=ujson.dumps)
+
+    async def close(self):
+        """Close client session and all pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @asynccontextmanager
+    async def request(
+            self,
+            method: str,
+            url: str,
+            access_token: Optional[str] = None,
+            **kwargs,
+    ) -> AsyncIterator[ClientResponse]:
+        """Make a request, authorized with given access token if it is passed"""
+        session = self.session
+        if access_token is not None:
+            kwargs['headers'] = {**kwargs.get('headers', {}), 'authorization-vbtc': access_token}
+        attempts = settings.api_client.retries + 1 if method == 'GET' and url in IDEMPOTENT_URLS else 1
+
+        endpoint = ENDPOINT_NAMES.get(url, 'UNKNOWN')
+        with tracer.span(f'kcash {endpoint}', method=method) as span:
+            for attempt in range(attempts):
+                self.circuit_breaker.check()
+                started_at = time.perf_counter()
+                try:
+                    response = await session.request(
+                        method,
+                        self._urls.get(url, url),
+                        timeout=self._timeouts.get(url, self._default_timeout),
+                        **kwargs,
+                    )
+                except (ClientError, asyncio.TimeoutError) as error:
+                    api_request_latency.observe(time.perf_counter() - started_at, endpoint, 'error')
+                    self.circuit_breaker.record_failure()
+                    if attempt == attempts - 1:
+                        raise UpstreamUnavailableError('Service is not responding, try again later', 503) from error
+                else:
+                    api_request_latency.observe(time.perf_counter() - started_at, endpoint, response.status)
+                    if response.status < 500:
+                        self.circuit_breaker.record_success()
+                        break
+                    response.release()
+                    self.circuit_breaker.record_failure()
+                    if attempt == attempts - 1:
+                        raise UpstreamUnavailableError('Service is not available, try again later', response.status)
+                await asyncio.sleep(settings.api_client.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+            if span is not None:
+                span.set_attribute('status', response.status)
+                span.set_attribute('attempts', attempt + 1)
+            try:
+                yield response
+            except (ClientError, asyncio.TimeoutError) as error:
+                self.circuit_breaker.record_failure()
+                raise UpstreamUnavailableError('Service is not responding, try again later', 503) from error
+            finally:
+                response.release()
+
+    def get(self, url: str, access_token: Optional[str] = None, **kwargs) -> AsyncContextManager[ClientResponse]:
+        return self.request('GET', url, access_token, **kwargs)
+
+    def post(self, url: str, access_token: Optional[str] = None, **kwargs) -> AsyncContextManager[ClientResponse]:
+        return self.request('POST', url, access_token, **kwargs)
+
+    def put(self, url: str, access_token: Optional[str] = None, **kwargs) -> AsyncContextManager[ClientResponse]:
+        return self.request('PUT', url, access_token, **kwargs)
+
+    def _create_endpoints_timeouts(self) -> dict[str, ClientTimeout]:
+        """Create connect and read timeouts for every API endpoint"""
+        timeouts = {}
+        for url in ApiURL:
+            timeouts[url.value] = self._default_timeout
+            if url.value in SLOW_URLS:
+                timeouts[url.value] = ClientTimeout(
+                    sock_connect=settings.api_client.connect_timeout,
+                    sock_read=settings.api_client.read_timeout * 2,
+                )
+        return timeouts
+
+
+api_client = KcashApiClient()
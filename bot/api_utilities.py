@@ -1,137 +1,204 @@
+import asyncio
+import base64
+import time
 from functools import wraps
-from typing import Union, Any, Callable, Awaitable, Optional
+from typing import Union, Callable, Awaitable, Optional
 
 import ujson
 from aiogram.dispatcher import FSMContext
-from aiohttp import ClientSession
 
+from bot.api_client import api_client
+from bot.cache import invalidates_user_data_cache, user_data_cache
 from bot.constants import ApiURL, Currency, Codes
-from bot.exceptions import AuthenticationError, TokenRefreshError, TWOFArequiredError, UserDataError
+from bot.exceptions import AuthenticationError, UpstreamUnavailableError
+from bot.metrics import count_api_errors
+from bot.responses import (
+    check_response,
+    read_balance_info,
+    read_response,
+    read_tokens,
+    read_username,
+)
+from bot.tenants import get_tenant_name
+from project_settings import settings
+
+_tokens_refreshes: dict[tuple[str, Union[str, int]], asyncio.Future] = {}  # By tenant and user
 
 
 def refresh_tokens_if_needed(
         access_api_func: Callable[[FSMContext, Optional[Union[str, dict[str]]]],
                                   Awaitable[Union[str, None, dict[str], tuple]]]
 ):
-    """if token expires for some reason make a request to refresh them and try again"""
+    """Refresh tokens in advance if access token is about to expire,
+    if token expires for some reason anyway make a request to refresh them and try again"""
     @wraps(access_api_func)
     async def wrapper(
             state: FSMContext,
             *args,
             **kwargs,
     ) -> Union[str, None, dict[str], tuple]:
+        access_token = await _get_tokens_from_state(state)
+        if _is_token_about_to_expire(access_token):
+            access_token = (await _refresh_tokens_once(state, access_token))['accessToken']
         try:
             return await access_api_func(state, *args, **kwargs)
         except AuthenticationError:
-            tokens = await get_new_tokens(state)
-            async with state.proxy() as data:
-                data['tokens'] = tokens
+            await _refresh_tokens_once(state, access_token)
             return await access_api_func(state, *args, **kwargs)
 
     return wrapper
 
 
+@count_api_errors
 async def process_authorize_user_request(
         user_data: Union[dict[str], str],
         url: str,
         state: FSMContext,
 ):
     """Process authorize request"""
-    session = ClientSession(json_serialize=ujson.dumps)
-    async with session.post(url, json=user_data) as response:
-        result = await response.json(loads=ujson.loads)
-        await session.close()
-    await _check_response_for_error(result)
+    async with api_client.post(url, json=user_data) as response:
+        tokens = await read_tokens(response)
+    await user_data_cache.invalidate(state.user)
     await state.reset_data()
     async with state.proxy() as data:
         data['login_in'] = True
-        data['tokens'] = dict(refreshToken=result['refreshToken'], accessToken=result['accessToken'])
+        data['tokens'] = tokens
 
 
+@count_api_errors
 @refresh_tokens_if_needed
 async def setup_2fa(state: FSMContext) -> dict[str]:
     """Process set up of 2fa"""
-    session = _create_authorized_session(await _get_tokens_from_state(state))
-    async with session.post(ApiURL.SETUP_2FA.value) as response:
-        result = await response.json(loads=ujson.loads)
-        await _check_response_for_error(result)
-        await session.close()
-    return result
+    async with api_client.post(ApiURL.SETUP_2FA.value, await _get_tokens_from_state(state)) as response:
+        return await read_response(response)
 
 
+@count_api_errors
 @refresh_tokens_if_needed
 async def get_info_for_successful_authorization_scenario(
         state: FSMContext,
 ) -> tuple[list[Currency], str]:
-    """Process getting all required info presented to user after successful authorization attempt"""
-    session = _create_authorized_session(await _get_tokens_from_state(state))
+    """Process getting all required info presented to user after successful authorization attempt.
+    Balance and account info are fetched concurrently, if one of them fails the other one is cancelled"""
+    access_token = await _get_tokens_from_state(state)
+    balance_info, username = await _gather_cancelling_on_error(
+        get_user_balance_info(access_token),
+        _get_username(access_token),
+        timeout=settings.api_client.user_info_timeout,
+    )
+    return balance_info, username
 
-    async with session.get(ApiURL.CHECK_BALANCE.value) as response:
-        balance_results = await response.json(loads=ujson.loads)
-        await _check_response_for_error(balance_results)
-        balance_info = _get_required_user_balance_info(balance_results)
 
-    async with session.get(ApiURL.ACCOUNT_INFO.value) as response:
-        account_info_results = await response.json(loads=ujson.loads)
-        await _check_response_for_error(account_info_results)
-        username = account_info_results['userName']
-        await session.close()
+async def get_user_balance_info(access_token: str) -> list[Currency]:
+    """Get all user currencies and their amount"""
+    async with api_client.get(ApiURL.CHECK_BALANCE.value, access_token) as response:
+        return await read_balance_info(response)
 
-    return balance_info, username
 
+async def _get_username(access_token: str) -> str:
+    """Get current user name"""
+    async with api_client.get(ApiURL.ACCOUNT_INFO.value, access_token) as response:
+        return await read_username(response)
 
+
+@count_api_errors
+@invalidates_user_data_cache
 @refresh_tokens_if_needed
 async def logout(state: FSMContext, log_out_type_code: str):
     """Process login out from current device or all"""
-    session = _create_authorized_session(await _get_tokens_from_state(state))
-    async with session.post(
+    async with api_client.post(
             url=ApiURL.LOG_OUT.value if log_out_type_code == Codes.LOG_OUT_FROM_CURRENT_DEVICE.value
-            else ApiURL.LOG_OUT_FROM_ALL.value
+            else ApiURL.LOG_OUT_FROM_ALL.value,
+            access_token=await _get_tokens_from_state(state),
     ) as response:
-        if response.content_type == 'application/json':
-            await _check_response_for_error(await response.json(loads=ujson.loads))
-        await session.close()
+        await check_response(response)
 
 
 async def get_new_tokens(state: FSMContext) -> dict[str]:
     """Process getting new access token"""
     tokens = await _get_tokens_from_state(state, all_tokens=True)
-    session = _create_authorized_session(tokens['accessToken'])
-    async with session.put(ApiURL.REFRESH_TOKEN.value, params={'RefreshToken': tokens['refreshToken']}) as response:
-        result = await response.json(loads=ujson.loads)
-        await _check_response_for_error(result, Codes.TOKEN_REFRESH_REQUEST.value)
-        await session.close()
-    return result
+    async with api_client.put(
+            ApiURL.REFRESH_TOKEN.value,
+            tokens['accessToken'],
+            params={'RefreshToken': tokens['refreshToken']},
+    ) as response:
+        return await read_tokens(response, Codes.TOKEN_REFRESH_REQUEST.value)
 
 
+@count_api_errors
+@invalidates_user_data_cache
 @refresh_tokens_if_needed
 async def change_password(state: FSMContext, user_data: dict[str]):
     """Process changing password using current"""
-    session = _create_authorized_session(await _get_tokens_from_state(state))
-    async with session.post(ApiURL.CHANGE_PASSWORD.value, json=user_data) as response:
-        await session.close()
-    if response.content_type == 'application/json':
-        await _check_response_for_error(await response.json(loads=ujson.loads))
+    async with api_client.post(
+            ApiURL.CHANGE_PASSWORD.value,
+            await _get_tokens_from_state(state),
+            json=user_data,
+    ) as response:
+        await check_response(response)
 
 
+@count_api_errors
+@invalidates_user_data_cache
 @refresh_tokens_if_needed
 async def enable_2fa(state: FSMContext, code: str):
     """Process enabling"""
-    session = _create_authorized_session(await _get_tokens_from_state(state))
-    async with session.post(ApiURL.ENABLE_2FA.value, params={'code': str(code)}) as response:
-        if response.content_type == 'application/json':
-            await _check_response_for_error(await response.json(loads=ujson.loads))
-        await session.close()
+    async with api_client.post(
+            ApiURL.ENABLE_2FA.value,
+            await _get_tokens_from_state(state),
+            params={'code': str(code)},
+    ) as response:
+        await check_response(response)
 
 
+@count_api_errors
+@invalidates_user_data_cache
 @refresh_tokens_if_needed
 async def disable_2fa(state: FSMContext, code: str):
     """Process disabling 2FA authentication"""
-    session = _create_authorized_session(await _get_tokens_from_state(state))
-    async with session.put(ApiURL.DISABLE_2FA.value, params={'code': code}) as response:
-        if response.content_type == 'application/json':
-            await _check_response_for_error(await response.json(loads=ujson.loads))
-        await session.close()
+    async with api_client.put(
+            ApiURL.DISABLE_2FA.value,
+            await _get_tokens_from_state(state),
+            params={'code': code},
+    ) as response:
+        await check_response(response)
+
+
+async def _refresh_tokens_once(state: FSMContext, expired_access_token: str) -> dict[str]:
+    """Refresh user tokens making only one request for all concurrent callers.
+    The same telegram user may have different kcash accounts in different tenant bots"""
+    key = (get_tenant_name(), state.user)
+    refresh = _tokens_refreshes.get(key)
+    if refresh is None:
+        tokens = await _get_tokens_from_state(state, all_tokens=True)
+        refresh = _tokens_refreshes.get(key)
+        if refresh is None:
+            if tokens['accessToken'] != expired_access_token:  # Already refreshed by another caller
+                return tokens
+            refresh = asyncio.ensure_future(_refresh_tokens(state))
+            _tokens_refreshes[key] = refresh
+            refresh.add_done_callback(lambda _: _tokens_refreshes.pop(key, None))
+    return await asyncio.shield(refresh)
+
+
+async def _refresh_tokens(state: FSMContext) -> dict[str]:
+    """Get new tokens and save them in state"""
+    tokens = await get_new_tokens(state)
+    async with state.proxy() as data:
+        data['tokens'] = tokens
+    return tokens
+
+
+def _is_token_about_to_expire(access_token: str) -> bool:
+    """Check if the given share of access token lifetime is already passed"""
+    try:
+        payload = access_token.split('.')[1]
+        claims = ujson.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        expires_at, issued_at = float(claims['exp']), float(claims.get('iat', claims['exp']))
+    except (IndexError, KeyError, TypeError, ValueError):  # Not a JWT, so lifetime is unknown
+        return False
+    refresh_margin = (expires_at - issued_at) * settings.api_client.token_refresh_ratio
+    return time.time() >= expires_at - refresh_margin
 
 
 async def _get_tokens_from_state(state: FSMContext, all_tokens: bool = False) -> Union[str, dict[str, str]]:
@@ -141,40 +208,15 @@ async def _get_tokens_from_state(state: FSMContext, all_tokens: bool = False) ->
     return tokens if all_tokens else tokens['accessToken']
 
 
-def _create_authorized_session(access_token: str) -> ClientSession:
-    """Create authorized Client Session with authorization token and required json serializer"""
-    session = ClientSession(json_serialize=ujson.dumps, headers={'authorization-vbtc': access_token})
-    return session
-
-
-async def _check_response_for_error(
-        response: dict[Any],
-        request_type_code: str = Codes.AUTHORIZED_REQUEST.value,
-):
-    """Check if error occurred during request"""
-    if 'error' in response.keys():
-        error_code, error_message = response['error']['messageCode'], response['error']['message']
-
-        if request_type_code == Codes.TOKEN_REFRESH_REQUEST.value:
-            raise TokenRefreshError(error_message, error_code)
-
-        elif response['error']['messageCode'] == 126:
-            raise TWOFArequiredError(error_message, error_code)
-
-        elif response['error']['messageCode'] == 171:
-            raise AuthenticationError(error_message, error_code)
-
-        raise UserDataError(error_message, error_code)
-
+async def _gather_cancelling_on_error(*awaitables: Awaitable, timeout: float) -> list:
+    """Run awaitables concurrently and cancel the rest of them as soon as one fails or timeout is reached"""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+    except asyncio.TimeoutError as error:
+        raise UpstreamUnavailableError('Service is not responding, try again later', 503) from error
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-def _get_required_user_balance_info(response_data: dict[str: list]) -> list[Currency]:
-    """Parse account info about user balance and return all currencies and their amount"""
-    balance_info = []
-    for wallet in response_data['wallets']:
-        balance_info.append(
-            Currency(
-                name=wallet.get('currencyName'),
-                available_balance=wallet.get('availableFunds'),
-            )
-        )
-    return balance_info
@@ -0,0 +1,192 @@
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
+from loguru import logger
+
+from bot.admission import AdmissionControlMiddleware
+from bot.api_client import api_client
+from bot.balance_refresher import balance_refresher
+from bot.cache import user_data_cache
+from bot.constants import MainForm
+from bot.deduplication import CallbackInFlightMiddleware, UpdateDeduplicationMiddleware
+from bot.handlers import register_handlers
+from bot.metrics import HandlerMetricsMiddleware, register_gauge, registry
+from bot.sender import message_sender
+from bot.sessions import session_sweeper
+from bot.storage import BufferedRedisStorage, HashRedisStorage, MemoryRedisStorage, StateBufferMiddleware
+from bot.tenants import TenantRegistry, add_tenant
+from bot.tracing import SpanExporter, TracedBot, TracingMiddleware, tracer
+from bot.workers import WORKER_PARTITION_KEY
+from project_settings import TenantSettings, settings
+
+storage_backends = {
+    'json': BufferedRedisStorage,
+    'hash': HashRedisStorage,
+    'memory': MemoryRedisStorage,
+}
+
+
+def create_bot(token: Optional[str] = None) -> Bot:
+    return (TracedBot if settings.tracing.enabled else Bot)(
+        token or settings.telegram_token,
+        server=TELEGRAM_PRODUCTION if settings.telegram_api_url is None
+        else TelegramAPIServer.from_base(settings.telegram_api_url),
+    )
+
+
+def create_storage(tenant: str = '', pool_owner: Optional[RedisStorage2] = None) -> RedisStorage2:
+    """Create FSM storage of configured backend, connection to redis is opened on first use.
+    Storage of tenant keeps its keys under its own prefix and uses connection pool of the main bot storage"""
+    options = {
+        'host': settings.redis_host,
+        'password': settings.redis_password,
+        'prefix': add_tenant('fsm', tenant),
+        'pool_owner': pool_owner,
+        'session_ttls': {
+            MainForm.data_submission.state: settings.sessions.data_submission_ttl,
+            MainForm.work_process.state: settings.sessions.authorized_ttl,
+        },
+        'default_session_ttl': settings.sessions.idle_ttl,
+    }
+    if settings.storage.backend == 'memory':
+        options.update(
+            shards=settings.storage.shards,
+            max_sessions=settings.storage.max_sessions,
+            flush_interval=settings.storage.flush_interval,
+            flush_batch_size=settings.storage.flush_batch_size,
+        )
+    return storage_backends[settings.storage.backend](**options)
+
+
+def create_dispatcher(
+        is_worker: bool = False,
+        tenant: Optional[TenantSettings] = None,
+        pool_owner: Optional[RedisStorage2] = None,
+) -> Dispatcher:
+    """Create dispatcher with FSM storage, middlewares and handlers of the main bot or of given tenant.
+    Updates deduplication is disabled in workers as updates published to them are deduplicated by intake process,
+    repeated button presses are caught by intake process too and released by workers"""
+    tenant_name = tenant.name if tenant is not None else ''
+    dispatcher = Dispatcher(
+        create_bot(tenant.token if tenant is not None else None),
+        storage=create_storage(tenant_name, pool_owner),
+    )
+    if not is_worker:  # Goes first, so updates dropped by it do not reach other middlewares
+        dispatcher.middleware.setup(UpdateDeduplicationMiddleware(
+            settings.deduplication.updates_cache_size,
+            redis_ttl=settings.deduplication.redis_ttl if settings.deduplication.use_redis else None,
+            prefix=add_tenant('received_update', tenant_name),
+        ))
+    dispatcher.middleware.setup(CallbackInFlightMiddleware(
+        redis_ttl=settings.workers.callback_in_flight_ttl if settings.workers.partitions else None,
+        is_worker=is_worker,
+        prefix=add_tenant('callback_in_flight', tenant_name),
+    ))
+    dispatcher.middleware.setup(StateBufferMiddleware(serialize_users=not settings.admission.enabled))
+    if settings.tracing.enabled:  # Goes after state buffer, so saving changes at the end of update is traced
+        dispatcher.middleware.setup(TracingMiddleware())
+    if settings.admission.enabled:
+        admission = dispatcher.middleware.setup(
+            AdmissionControlMiddleware(settings.admission.max_in_flight, settings.admission.queue_size)
+        )
+        if settings.metrics.enabled and tenant is None:
+            register_gauge('bot_updates_waiting_admission', 'Updates waiting for their turn', admission.waiting)
+    if settings.metrics.enabled:
+        dispatcher.middleware.setup(HandlerMetricsMiddleware())
+        if tenant is None:
+            register_gauge(
+                'bot_outgoing_messages_in_queue',
+                'Messages waiting to be sent',
+                message_sender.queue_size,
+            )
+    register_handlers(dispatcher)
+    return dispatcher
+
+
+def create_tenants() -> TenantRegistry:
+    """Create dispatchers of the main bot and of configured tenants sharing its redis connection pool"""
+    tenants = TenantRegistry()
+    main_dispatcher = create_dispatcher()
+    tenants.add(main_dispatcher)
+    for tenant in settings.tenants:
+        tenants.add(create_dispatcher(tenant=tenant, pool_owner=main_dispatcher.storage), tenant.name)
+    return tenants
+
+
+def get_metrics_port(dispatcher: Dispatcher) -> int:
+    """Get port metrics of the process are served on, every worker serves them on its own port
+    following the port of intake process"""
+    partition = dispatcher.get(WORKER_PARTITION_KEY)
+    return settings.metrics.port if partition is None else settings.metrics.port + partition + 1
+
+
+async def on_startup(dispatcher: Dispatcher):
+    """Opening pooled kcash API client, outgoing messages queue and background jobs on bot startup event"""
+    await on_tenants_startup([dispatcher])
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    """Sending queued messages, closing kcash API client and redis connection on bot shutdown event"""
+    await on_tenants_shutdown([dispatcher])
+
+
+async def on_tenants_startup(dispatchers: list[Dispatcher]):
+    """Start services shared by all bots hosted by the process, the first bot is the main one,
+    and background jobs of every bot"""
+    main_dispatcher = dispatchers[0]
+    await api_client.start()
+    user_data_cache.setup(
+        ttl=settings.user_data_cache.ttl,
+        max_size=settings.user_data_cache.max_size,
+        redis_storage=main_dispatcher.storage if settings.user_data_cache.use_redis else None,
+    )
+    await message_sender.start(
+        main_dispatcher.bot,
+        global_rate=settings.sender.global_rate,
+        chat_rate=settings.sender.chat_rate,
+        chat_burst=settings.sender.chat_burst,
+    )
+    if settings.metrics.enabled:
+        await registry.start_server(settings.metrics.host, get_metrics_port(main_dispatcher))
+    if settings.tracing.enabled:
+        await tracer.start(
+            SpanExporter(
+                settings.tracing.destination,
+                batch_size=settings.tracing.batch_size,
+                flush_interval=settings.tracing.flush_interval,
+                max_queue_size=settings.tracing.max_queue_size,
+                service_name=settings.tracing.service_name,
+            ),
+            sample_rate=settings.tracing.sample_rate,
+        )
+    for dispatcher in dispatchers:
+        if settings.balance_refresher.enabled:
+            await balance_refresher.start(
+                dispatcher,
+                interval=settings.balance_refresher.interval,
+                concurrency=settings.balance_refresher.concurrency,
+                batch_size=settings.balance_refresher.batch_size,
+            )
+        if settings.sessions.sweeper_enabled:
+            await session_sweeper.start(
+                dispatcher,
+                interval=settings.sessions.sweep_interval,
+                batch_size=settings.sessions.sweep_batch_size,
+            )
+
+
+async def on_tenants_shutdown(dispatchers: list[Dispatcher]):
+    """Stop services of all bots hosted by the process, redis connection pool of the main bot is closed last"""
+    logger.warning('Shutting down bot')
+    logger.info('User data cache stats: {stats}', stats=user_data_cache.stats())
+    await registry.stop_server()
+    await balance_refresher.close()
+    await session_sweeper.close()
+    await message_sender.close(settings.sender.shutdown_timeout)
+    await api_client.close()
+    for dispatcher in reversed(dispatchers):
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+    await tracer.close()
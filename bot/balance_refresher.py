@@ -0,0 +1,153 @@
+import asyncio
+import random
+from typing import Optional
+
+import ujson
+from aiogram import Bot, Dispatcher
+from loguru import logger
+
+from bot.api_utilities import get_user_balance_info
+from bot.bot_utilities import format_balance_info
+from bot.cache import user_data_cache
+from bot.constants import Currency, MessagePriority
+from bot.exceptions import TgBotError
+from bot.locks import RedisLock
+from bot.sender import message_sender
+from bot.tenants import add_tenant, get_tenant_name
+
+
+class BalanceRefresher:
+    """Poll balance of logged in users in background and notify them when it changes.
+    Polls of one round are spread over refresh interval with jitter and limited by concurrency cap,
+    only one bot process polls at a time and rounds start once per interval. Users of every bot hosted
+    by the process are refreshed by its own worker, the concurrency cap is shared by all of them"""
+
+    def __init__(self, prefix: str = 'balance_refresher'):
+        self._dispatchers: dict[str, Dispatcher] = {}
+        self._interval = 0.0
+        self._batch_size = 0
+        self._prefix = prefix
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._workers: list[asyncio.Task] = []
+        self._refreshes: set[asyncio.Task] = set()
+
+    async def start(self, dispatcher: Dispatcher, interval: float, concurrency: int, batch_size: int):
+        """Start refreshing balances of users whose tokens are kept in dispatcher storage"""
+        self._dispatchers[get_tenant_name(dispatcher)] = dispatcher
+        self._interval = interval
+        self._batch_size = batch_size
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(concurrency)
+        self._workers.append(asyncio.create_task(self._run(dispatcher)))
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        for refresh in self._refreshes:
+            refresh.cancel()
+
+    async def track(self, user_id: int):
+        """Start refreshing balance of logged in user of the current bot"""
+        tenant = get_tenant_name()
+        dispatcher = self._dispatchers.get(tenant)
+        if dispatcher is not None:
+            redis = await dispatcher.storage.redis()
+            await redis.sadd(self._generate_key(tenant, 'users'), user_id)
+
+    async def untrack(self, user_id: int):
+        """Stop refreshing balance of logged out user of the current bot"""
+        tenant = get_tenant_name()
+        dispatcher = self._dispatchers.get(tenant)
+        if dispatcher is not None:
+            redis = await dispatcher.storage.redis()
+            async with redis.pipeline(transaction=False) as pipe:
+                await pipe.srem(self._generate_key(tenant, 'users'), user_id).hdel(
+                    self._generate_key(tenant, 'snapshots'), user_id
+                ).execute()
+
+    def _generate_key(self, tenant: str, name: str) -> str:
+        return f'{add_tenant(self._prefix, tenant)}:{name}'
+
+    async def _run(self, dispatcher: Dispatcher):
+        """Refresh balances of users of one bot, which is current in the context of refreshes"""
+        Bot.set_current(dispatcher.bot)
+        Dispatcher.set_current(dispatcher)
+        loop = asyncio.get_running_loop()
+        lock = RedisLock(
+            await dispatcher.storage.redis(),
+            self._generate_key(get_tenant_name(dispatcher), 'lock'),
+            ttl=self._interval,
+        )
+        while True:
+            started_at = loop.time()
+            async with lock.hold() as is_taken:
+                if is_taken:
+                    try:
+                        await self._refresh_round(dispatcher)
+                    except Exception:
+                        logger.exception('Cause exception while refreshing balances')
+            await asyncio.sleep(max(self._interval - (loop.time() - started_at), 0))
+
+    async def _refresh_round(self, dispatcher: Dispatcher):
+        """Refresh balance of every tracked user once, reading them in batches"""
+        redis = await dispatcher.storage.redis()
+        users_key = self._generate_key(get_tenant_name(dispatcher), 'users')
+        users_count = await redis.scard(users_key)
+        if not users_count:
+            return
+        spacing = self._interval / users_count
+        cursor = None
+        while cursor != 0:
+            cursor, user_ids = await redis.sscan(users_key, cursor or 0, count=self._batch_size)
+            for user_id in user_ids:
+                await self._semaphore.acquire()
+                refresh = asyncio.create_task(self._refresh_user_balance(dispatcher, int(user_id)))
+                self._refreshes.add(refresh)
+                refresh.add_done_callback(self._finish_refresh)
+                await asyncio.sleep(random.uniform(0, 2 * spacing))
+
+    def _finish_refresh(self, refresh: asyncio.Task):
+        self._refreshes.discard(refresh)
+        self._semaphore.release()
+        if not refresh.cancelled() and refresh.exception() is not None:
+            logger.opt(exception=refresh.exception()).error('Cause exception while refreshing user balance')
+
+    async def _refresh_user_balance(self, dispatcher: Dispatcher, user_id: int):
+        """Get user balance and notify user if it differs from the last snapshot"""
+        redis = await dispatcher.storage.redis()
+        data = await dispatcher.current_state(chat=user_id, user=user_id).get_data()
+        if 'tokens' not in data:  # User has logged out or got error and has to log in again
+            await self.untrack(user_id)
+            return
+        try:
+            balance_info = await get_user_balance_info(data['tokens']['accessToken'])
+        except TgBotError as error:  # Expired tokens are refreshed when user gets back to bot
+            logger.debug(
+                'Can not refresh balance of user {user_id}. {error}',
+                user_id=user_id,
+                error=error,
+                event='balance_refresh_failure',
+            )
+            return
+
+        snapshot = self._serialize(balance_info)
+        snapshots_key = self._generate_key(get_tenant_name(dispatcher), 'snapshots')
+        async with redis.pipeline(transaction=False) as pipe:
+            previous_snapshot, _ = await pipe.hget(snapshots_key, user_id).hset(
+                snapshots_key, user_id, snapshot
+            ).execute()
+        if previous_snapshot is None or previous_snapshot == snapshot:
+            return
+        await user_data_cache.invalidate(user_id)
+        await message_sender.send(
+            user_id,
+            'Your balance has changed:' + format_balance_info(balance_info),
+            priority=MessagePriority.INFORMATIONAL,
+        )
+
+    @staticmethod
+    def _serialize(balance_info: list[Currency]) -> str:
+        return ujson.dumps([(currency.name, currency.available_balance) for currency in balance_info])
+
+
+balance_refresher = BalanceRefresher()
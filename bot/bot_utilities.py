@@ -1,19 +1,18 @@
 import itertools
 from enum import EnumMeta
+from functools import lru_cache
 from typing import Optional, Any, Union
 
 import ujson
-from aiogram import Bot
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 
 from bot.api_utilities import get_info_for_successful_authorization_scenario
+from bot.cache import user_data_cache
+from bot.sender import message_sender
 from bot.constants import (
-    data_sample,
-    SIGN_IN_DATA,
-    SIGN_UP_DATA,
-    PASSWORD_CHANGE_DATA,
     Codes,
+    Currency,
     MainMenuButtons,
     StartCommandProcessButtons,
     MainForm,
@@ -35,6 +34,15 @@ def create_inline_keyboard(buttons: list[str],
     return keyboard
 
 
+@lru_cache(maxsize=None)
+def get_serialized_inline_keyboard(
+        buttons: tuple[str, ...],
+        callback_queries: Optional[tuple] = None,
+) -> str:
+    """Get inline keyboard serialized as reply markup, every keyboard is built only once"""
+    return create_inline_keyboard(list(buttons), callback_queries).as_json()
+
+
 def _callback_data_normalize(data: Any) -> Optional[str]:
     """Process data to appear as str in callbacks"""
     if isinstance(data, str):
@@ -54,8 +62,32 @@ def get_all_enum_values(
     return list(value_map)
 
 
+START_KEYBOARD = get_serialized_inline_keyboard(
+    tuple(get_all_enum_values(StartCommandProcessButtons)),
+    callback_queries=(Codes.SIGN_IN_USER.value, Codes.REGISTER_USER.value),
+)
+MAIN_MENU_KEYBOARD = get_serialized_inline_keyboard(
+    tuple(get_all_enum_values(MainMenuButtons)),
+    callback_queries=(
+        Codes.PASSWORD_CHANGE.value,
+        Codes.ENABLE_2FA.value,
+        Codes.DISABLE_2FA.value,
+        Codes.LOG_OUT_FROM_CURRENT_DEVICE.value,
+        Codes.LOG_OUT_FROM_ALL.value,
+    ),
+)
+BACK_TO_START_PAGE_KEYBOARD = get_serialized_inline_keyboard(('Get back to the main page',))
+
+
+def format_balance_info(balance_info: list[Currency]) -> str:
+    """Format every currency balance on a new line"""
+    user_balance_info = ''
+    for currency in balance_info:
+        user_balance_info += f'\n{currency.name}--balance:{currency.available_balance}'
+    return user_balance_info
+
+
 async def process_error_scenario(
-        bot: Bot,
         message: Union[types.Message, types.CallbackQuery],
         error: str,
         state: FSMContext
@@ -63,76 +95,33 @@ async def process_error_scenario(
     """Process error scenario when accessing API"""
     await state.reset_data()
     await MainForm.start.set()
-    await bot.send_message(
+    await message_sender.send(
         message.from_user.id,
         f'Error occurred {error}',
-        reply_markup=create_inline_keyboard(['Get back to the main page'])
+        reply_markup=BACK_TO_START_PAGE_KEYBOARD,
     )
 
 
-async def show_start_message(bot: Bot, message: Union[types.CallbackQuery, types.Message]):
+async def show_start_message(message: Union[types.CallbackQuery, types.Message]):
     """Show start command message"""
-    await bot.send_message(
+    await message_sender.send(
         message.from_user.id,
         'Welcome! Do you want to register or log in?',
-        reply_markup=create_inline_keyboard(
-            get_all_enum_values(StartCommandProcessButtons),
-            callback_queries=(Codes.SIGN_IN_USER.value, Codes.REGISTER_USER.value),
-        )
+        reply_markup=START_KEYBOARD,
     )
 
 
-async def create_required_sample_in_state(state: FSMContext, task_type_code: str):
-    """Process creating data sample in state"""
-    required_data = data_sample[task_type_code]
-    async with state.proxy() as data:
-        data['current_task'] = dict(
-            type=task_type_code,
-            current_index=0,
-            required_data=required_data,
-        )
-        if required_data == SIGN_IN_DATA:
-            data['user_info'] = dict(
-                login='',
-                password='',
-                capcha='',
-                twoFaPin='',
-            )
-        elif required_data == SIGN_UP_DATA:
-            data['user_info'] = dict(
-                email='',
-                password='',
-                login='',
-                capcha='',
-            )
-        elif required_data == PASSWORD_CHANGE_DATA:
-            data['user_info'] = dict(
-                email='',
-                currentPassword='',
-                newPassword='',
-                twoFaPin='',
-            )
-
-
-async def show_user_data(bot: Bot, message: Union[types.Message, types.CallbackQuery], state: FSMContext):
+async def show_user_data(message: Union[types.Message, types.CallbackQuery], state: FSMContext):
     """Show all user data"""
-    balance_info, user_name = await get_info_for_successful_authorization_scenario(state)
-    user_balance_info = ''
-    for currency in balance_info:
-        user_balance_info += f'\n{currency.name}--balance:{currency.available_balance}'
-    await bot.send_message(
+    user_data = await user_data_cache.get(message.from_user.id)
+    if user_data is None:
+        user_data = await get_info_for_successful_authorization_scenario(state)
+        await user_data_cache.set(message.from_user.id, *user_data)
+    balance_info, user_name = user_data
+    await message_sender.send(
         message.from_user.id,
-        f'{user_name}\n\n' + user_balance_info,
-        reply_markup=create_inline_keyboard(
-            get_all_enum_values(MainMenuButtons),
-            callback_queries=(
-                Codes.PASSWORD_CHANGE.value,
-                Codes.ENABLE_2FA.value,
-                Codes.DISABLE_2FA.value,
-                Codes.LOG_OUT_FROM_CURRENT_DEVICE.value,
-                Codes.LOG_OUT_FROM_ALL.value,
-            )
-        )
+        f'{user_name}\n\n' + format_balance_info(balance_info),
+        reply_markup=MAIN_MENU_KEYBOARD,
     )
 
 
@@ -0,0 +1,126 @@
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Optional, Callable, Awaitable, Union
+
+import ujson
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
+from aiogram.dispatcher import FSMContext
+
+from bot.constants import Currency
+from bot.metrics import user_data_cache_hits, user_data_cache_misses, user_data_cache_redis_hits
+from bot.tenants import add_tenant, get_tenant_name
+
+UserData = tuple[list[Currency], str]
+UserKey = tuple[str, int]  # Tenant and telegram user id
+
+
+class UserDataCache:
+    """Cache of user wallets and profile info keyed by tenant of the current bot and telegram user id.
+    Entries live in process LRU with TTL and, if redis storage is passed, in redis shared between bot replicas"""
+
+    def __init__(self, prefix: str = 'user_data_cache'):
+        self._ttl = 0.0  # Nothing is cached until cache is set up
+        self._max_size = 0
+        self._redis_storage: Optional[RedisStorage2] = None
+        self._prefix = prefix
+        self._entries: OrderedDict[UserKey, tuple[float, UserData]] = OrderedDict()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def setup(self, ttl: float, max_size: int, redis_storage: Optional[RedisStorage2] = None):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._redis_storage = redis_storage
+
+    async def get(self, user_id: int) -> Optional[UserData]:
+        """Get cached user data if it is not expired yet"""
+        user_key = (get_tenant_name(), user_id)
+        entry = self._entries.get(user_key)
+        if entry is not None:
+            expires_at, user_data = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(user_key)
+                self.hits += 1
+                user_data_cache_hits.inc()
+                return user_data
+            del self._entries[user_key]
+
+        if self._redis_storage is not None:
+            redis = await self._redis_storage.redis()
+            raw_user_data = await redis.get(self._generate_key(user_key))
+            if raw_user_data:
+                user_data = self._deserialize(raw_user_data)
+                self._store_locally(user_key, user_data)
+                self.redis_hits += 1
+                user_data_cache_redis_hits.inc()
+                return user_data
+
+        self.misses += 1
+        user_data_cache_misses.inc()
+        return None
+
+    async def set(self, user_id: int, balance_info: list[Currency], user_name: str):
+        """Cache user data"""
+        user_key = (get_tenant_name(), user_id)
+        user_data = (balance_info, user_name)
+        self._store_locally(user_key, user_data)
+        if self._redis_storage is not None:
+            redis = await self._redis_storage.redis()
+            await redis.set(self._generate_key(user_key), self._serialize(user_data), ex=max(int(self._ttl), 1))
+
+    async def invalidate(self, user_id: int):
+        """Drop cached user data after it was changed"""
+        user_key = (get_tenant_name(), user_id)
+        self._entries.pop(user_key, None)
+        if self._redis_storage is not None:
+            redis = await self._redis_storage.redis()
+            await redis.delete(self._generate_key(user_key))
+
+    def stats(self) -> dict[str, int]:
+        """Get cache hit and miss counters"""
+        return dict(hits=self.hits, redis_hits=self.redis_hits, misses=self.misses, size=len(self._entries))
+
+    def _store_locally(self, user_key: UserKey, user_data: UserData):
+        self._entries[user_key] = (time.monotonic() + self._ttl, user_data)
+        self._entries.move_to_end(user_key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def _generate_key(self, user_key: UserKey) -> str:
+        tenant, user_id = user_key
+        return f'{add_tenant(self._prefix, tenant)}:{user_id}'
+
+    @staticmethod
+    def _serialize(user_data: UserData) -> str:
+        balance_info, user_name = user_data
+        return ujson.dumps(
+            dict(
+                balance=[(currency.name, currency.available_balance) for currency in balance_info],
+                user_name=user_name,
+            )
+        )
+
+    @staticmethod
+    def _deserialize(raw_user_data: str) -> UserData:
+        user_data = ujson.loads(raw_user_data)
+        balance_info = [Currency(name=name, available_balance=amount) for name, amount in user_data['balance']]
+        return balance_info, user_data['user_name']
+
+
+def invalidates_user_data_cache(
+        api_func: Callable[..., Awaitable[Union[str, None, dict[str], tuple]]]
+):
+    """Drop cached user data after calling API func which may change it"""
+    @wraps(api_func)
+    async def wrapper(state: FSMContext, *args, **kwargs) -> Union[str, None, dict[str], tuple]:
+        try:
+            return await api_func(state, *args, **kwargs)
+        finally:
+            await user_data_cache.invalidate(state.user)
+
+    return wrapper
+
+
+user_data_cache = UserDataCache()
@@ -1,16 +1,8 @@
 import enum
 from dataclasses import dataclass
 
-from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.redis import RedisStorage2
 from aiogram.dispatcher.filters.state import State, StatesGroup
 
-from project_settings import settings
-
-bot = Bot(settings.telegram_token)
-dp = Dispatcher(bot, storage=RedisStorage2(host='bots_redis', password=settings.redis_password))
-
-
 SIGN_IN_DATA = ('login', 'password', 'capcha', 'twoFaPin')
 SIGN_UP_DATA = ('email', 'password', 'userName', 'capcha')
 PASSWORD_CHANGE_DATA = ('email', 'currentPassword', 'newPassword', 'twoFaPin')
@@ -18,6 +10,8 @@ PASSWORD_CHANGE_DATA = ('email', 'currentPassword', 'newPassword', 'twoFaPin')
 
 @dataclass
 class Currency:
+    __slots__ = ('name', 'available_balance')
+
     name: str
     available_balance: float
 
@@ -53,6 +47,12 @@ class ApiURL(enum.Enum):
     ACCOUNT_INFO = 'https://front.kcash.ru/api/fo/Login/GetCurrentCustomer'
 
 
+class MessagePriority(enum.IntEnum):
+    """Priority of outgoing messages, lower is sent first"""
+    INTERACTIVE = 0
+    INFORMATIONAL = 1
+
+
 class MainMenuButtons(enum.Enum):
     """Main menu buttons representing all bot fucntional"""
     CHANGE_PASSWORD = 'Change password'
@@ -74,9 +74,3 @@ class MainForm(StatesGroup):
     data_submission = State()
     work_process = State()
 
-
-data_sample = {
-    Codes.SIGN_IN_USER.value: SIGN_IN_DATA,
-    Codes.REGISTER_USER.value: SIGN_UP_DATA,
-    Codes.PASSWORD_CHANGE.value: PASSWORD_CHANGE_DATA,
-}
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from typing import Optional
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from bot.metrics import duplicate_updates
+
+PROCESSING_TEXT = 'Processing, please wait'
+
+
+class UpdateDeduplicationMiddleware(BaseMiddleware):
+    """Drop updates Telegram delivers again. Ids of received updates are kept in process LRU
+    and, if redis ttl is passed, in redis keys shared between bot replicas"""
+
+    def __init__(self, max_size: int, redis_ttl: Optional[int] = None, prefix: str = 'received_update'):
+        self._max_size = max_size
+        self._redis_ttl = redis_ttl
+        self._prefix = prefix
+        self._update_ids: OrderedDict[int, None] = OrderedDict()
+        super(UpdateDeduplicationMiddleware, self).__init__()
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if update.update_id in self._update_ids or not await self._is_first_delivery(update.update_id):
+            duplicate_updates.inc('update')
+            raise CancelHandler()
+        self._update_ids[update.update_id] = None
+        if len(self._update_ids) > self._max_size:
+            self._update_ids.popitem(last=False)
+
+    async def _is_first_delivery(self, update_id: int) -> bool:
+        if self._redis_ttl is None:
+            return True
+        redis = await self.manager.dispatcher.storage.redis()
+        return bool(await redis.set(f'{self._prefix}:{update_id}', 1, nx=True, ex=self._redis_ttl))
+
+
+class CallbackInFlightMiddleware(BaseMiddleware):
+    """Answer the same button pressed again while its previous press is processed or waits for its turn
+    with a toast instead of processing it once more. If redis ttl is passed, presses in flight are kept
+    in redis keys, so a press published to a worker stays in flight until the worker releases it
+    after processing or until the key expires"""
+
+    def __init__(self, redis_ttl: Optional[int] = None, is_worker: bool = False, prefix: str = 'callback_in_flight'):
+        self._redis_ttl = redis_ttl
+        self._is_worker = is_worker
+        self._prefix = prefix
+        self._in_flight: set[tuple[int, Optional[str]]] = set()
+        super(CallbackInFlightMiddleware, self).__init__()
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        callback_query = update.callback_query
+        if callback_query is None:
+            return
+        key = (callback_query.from_user.id, callback_query.data)
+        if not self._is_worker and not await self._acquire(key):  # Worker gets presses acquired by intake process
+            duplicate_updates.inc('callback_query')
+            await callback_query.answer(PROCESSING_TEXT)
+            raise CancelHandler()
+        data['in_flight_key'] = key
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        if 'in_flight_key' in data and not data.get('is_update_published'):
+            await self._release(data['in_flight_key'])
+
+    async def _acquire(self, key: tuple[int, Optional[str]]) -> bool:
+        if self._redis_ttl is None:
+            if key in self._in_flight:
+                return False
+            self._in_flight.add(key)
+            return True
+        redis = await self.manager.dispatcher.storage.redis()
+        return bool(await redis.set(self._generate_key(key), 1, nx=True, ex=self._redis_ttl))
+
+    async def _release(self, key: tuple[int, Optional[str]]):
+        if self._redis_ttl is None:
+            self._in_flight.discard(key)
+            return
+        redis = await self.manager.dispatcher.storage.redis()
+        await redis.delete(self._generate_key(key))
+
+    def _generate_key(self, key: tuple[int, Optional[str]]) -> str:
+        user_id, callback_data = key
+        return f'{self._prefix}:{user_id}:{callback_data}'
@@ -23,3 +23,7 @@ class TWOFArequiredError(TgBotError):
 
 class UserDataError(TgBotError):
     pass
+
+
+class UpstreamUnavailableError(TgBotError):
+    pass
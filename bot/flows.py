@@ -0,0 +1,82 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from aiogram.dispatcher import FSMContext
+
+from bot.constants import (
+    SIGN_IN_DATA,
+    SIGN_UP_DATA,
+    PASSWORD_CHANGE_DATA,
+    Codes,
+    ApiURL,
+)
+
+
+@dataclass(frozen=True)
+class FlowStep:
+    field: Optional[str]  # User info field filled with submitted message, None if nothing is expected anymore
+    submit: bool  # Whether collected data is submitted to API at this step
+    prompt: Optional[str]  # Prompt for the next field when data is not submitted yet
+
+
+@dataclass(frozen=True)
+class Flow:
+    code: str
+    user_info_fields: tuple[str, ...]
+    steps: tuple[FlowStep, ...]
+    url: Optional[str] = None
+
+    def get_step(self, step: int) -> FlowStep:
+        """Get step by number, messages sent after the last step only submit data again"""
+        return self.steps[min(step, len(self.steps) - 1)]
+
+
+def compile_flow(
+        code: str,
+        fields: tuple[str, ...],
+        submit_from: int,
+        user_info_fields: Optional[tuple[str, ...]] = None,
+        url: Optional[str] = None,
+) -> Flow:
+    """Build steps table of flow asking for fields one by one. Data is submitted starting from
+    the field with given index, so the fields after it (2FA pin) are asked only when API requires them"""
+    steps = []
+    for index, field in enumerate(fields):
+        submit = index >= submit_from
+        steps.append(FlowStep(field, submit, None if submit else f'Type your {fields[index + 1]}'))
+    steps.append(FlowStep(None, True, None))
+    return Flow(code, user_info_fields or fields, tuple(steps), url)
+
+
+FLOWS = {flow.code: flow for flow in (
+    compile_flow(Codes.SIGN_IN_USER.value, SIGN_IN_DATA, submit_from=2, url=ApiURL.LOG_IN.value),
+    compile_flow(
+        Codes.REGISTER_USER.value,
+        SIGN_UP_DATA,
+        submit_from=3,
+        user_info_fields=('email', 'password', 'login', 'capcha'),
+        url=ApiURL.REGISTER.value,
+    ),
+    compile_flow(Codes.PASSWORD_CHANGE.value, PASSWORD_CHANGE_DATA, submit_from=2),
+)}
+
+
+async def start_flow(state: FSMContext, code: str):
+    """Save flow id, its first step and empty user info in state"""
+    async with state.proxy() as data:
+        data['flow'] = code
+        data['step'] = 0
+        data['user_info'] = dict.fromkeys(FLOWS[code].user_info_fields, '')
+
+
+async def submit_flow_step(state: FSMContext, text: str) -> tuple[Flow, FlowStep]:
+    """Save submitted text in the field of current flow step and move to the next step"""
+    async with state.proxy() as data:
+        if 'flow' not in data:  # State saved before flows were introduced
+            data['flow'], data['step'] = data['current_task']['type'], data['current_task']['current_index']
+        flow = FLOWS[data['flow']]
+        step = flow.get_step(data['step'])
+        if step.field is not None:
+            data['user_info'][step.field] = text
+        data['step'] += 1
+    return flow, step
@@ -0,0 +1,218 @@
+from typing import Union
+
+from aiogram import Dispatcher, types
+from aiogram.dispatcher import FSMContext
+from loguru import logger
+
+from bot.api_utilities import (
+    process_authorize_user_request,
+    disable_2fa,
+    enable_2fa,
+    setup_2fa,
+    logout,
+    change_password,
+)
+from bot.balance_refresher import balance_refresher
+from bot.bot_utilities import (
+    show_user_data,
+    show_start_message,
+    process_error_scenario,
+)
+from bot.constants import MainForm, Codes, MessagePriority
+from bot.exceptions import TokenRefreshError, TWOFArequiredError, UserDataError, UpstreamUnavailableError
+from bot.flows import start_flow, submit_flow_step
+from bot.sender import message_sender
+
+
+async def process_start_command(message: Union[types.Message, types.CallbackQuery], state: FSMContext):
+    """Process start command and initiate register or sign in process"""
+
+    if isinstance(message, types.Message):
+        logger.debug('User {user_id} has started working with bot', user_id=message.from_user.id, event='start')
+        await show_start_message(message)
+        await MainForm.start.set()
+
+    if isinstance(message, types.CallbackQuery):
+        if message.data == 'Get back to the main page':  # For some reason keyboard doesnt appear with 1 button and
+            #  callback so we keep callback the same as text on the button
+            await show_start_message(message)
+            return
+        await start_flow(state, message.data)
+        logger.debug(
+            'User {user_id} has started process code: {code}',
+            user_id=message.from_user.id,
+            code=message.data,
+            event='process_start',
+        )
+        await MainForm.data_submission.set()
+        await message_sender.send(message.from_user.id, 'Type your email')
+
+
+async def process_user_data_submission(message: types.Message, state: FSMContext):
+    """Process user data submission and showing login and balance info"""
+    flow, step = await submit_flow_step(state, message.text)
+    logger.debug(
+        'User {user_id} has submitted data for process code: {code}',
+        user_id=message.from_user.id,
+        code=flow.code,
+        event='data_submission',
+    )
+
+    if not step.submit:
+        await message_sender.send(message.from_user.id, step.prompt)
+        return
+
+    async with state.proxy() as data:
+        confirmed_data = data.keys()
+        user_data = data['user_info']
+    try:
+        if flow.code == Codes.PASSWORD_CHANGE.value:
+            await change_password(state, user_data)
+            await message_sender.send(
+                message.from_user.id,
+                'Password was changed!',
+                priority=MessagePriority.INFORMATIONAL,
+            )
+            await show_user_data(message, state)
+            await MainForm.work_process.set()
+            return
+
+        await process_authorize_user_request(user_data, flow.url, state)
+
+    except TWOFArequiredError as error:
+        logger.debug(
+            '2FA pin required to process code: {code} task for user {user_id}',
+            user_id=message.from_user.id,
+            code=flow.code,
+            event='2fa_required',
+        )
+        await message_sender.send(message.from_user.id, error.error_message)
+        return
+
+    except UserDataError as error:
+        logger.debug(
+            'Unsuccessful process code: {code} attempt by user {user_id}.{error}',
+            user_id=message.from_user.id,
+            code=flow.code,
+            error=error,
+            event='process_failure',
+        )
+        if 'log_in' not in confirmed_data:
+            await process_error_scenario(message, error.error_message, state)
+            return
+        await message_sender.send(message.from_user.id, f'Error occurred. {error.error_message}')
+        await show_user_data(message, state)
+        return
+
+    logger.debug(
+        'Successful authorization attempt by user {user_id}',
+        user_id=message.from_user.id,
+        event='authorization',
+    )
+    await balance_refresher.track(message.from_user.id)
+    await show_user_data(message, state)
+    await MainForm.work_process.set()
+
+
+async def process_main_menu_funcs(message: Union[types.CallbackQuery, types.Message], state: FSMContext):
+    """Process every func defined in test task to be done after successful authorization"""
+    async with state.proxy() as data:
+        if isinstance(message, types.CallbackQuery):
+            data['current_task'] = message.data
+        current_task = data['current_task']
+
+    try:
+
+        if isinstance(message, types.CallbackQuery):
+            logger.debug(
+                'User {user_id} has initiated process code: {code}',
+                user_id=message.from_user.id,
+                code=message.data,
+                event='process_start',
+            )
+
+            if message.data == Codes.DISABLE_2FA.value:
+                await message_sender.send(message.from_user.id, 'Type your 2fa code')
+
+            elif message.data == Codes.PASSWORD_CHANGE.value:
+                await message_sender.send(message.from_user.id, 'Type your email')
+                await start_flow(state, message.data)
+                await MainForm.data_submission.set()
+
+            elif message.data == Codes.ENABLE_2FA.value:
+                result = await setup_2fa(state)
+                await message_sender.send(
+                    message.from_user.id,
+                    f'Use manual key:{result["manualEntryKey"]}'
+                    f' and your account name {result["account"]} to setup 2fa or '
+                    f'check this QR code: {result["qrCodeSetupImageUrl"]} and send code back'
+                )
+
+            elif message.data in (Codes.LOG_OUT_FROM_CURRENT_DEVICE.value, Codes.LOG_OUT_FROM_ALL.value):
+                await logout(state, message.data)
+                await balance_refresher.untrack(message.from_user.id)
+                await show_start_message(message)
+                await MainForm.start.set()
+
+        if isinstance(message, types.Message):
+            logger.debug(
+                'User {user_id} has submitted 2FA code for process code: {code}',
+                user_id=message.from_user.id,
+                code=current_task,
+                event='2fa_submission',
+            )
+
+            if current_task == Codes.DISABLE_2FA.value:
+                await disable_2fa(state, message.text)
+                await message_sender.send(
+                    message.from_user.id,
+                    '2FA is disabled!',
+                    priority=MessagePriority.INFORMATIONAL,
+                )
+                await show_user_data(message, state)
+                return
+
+            await enable_2fa(state, message.text)
+            await message_sender.send(
+                message.from_user.id,
+                '2FA is enabled!',
+                priority=MessagePriority.INFORMATIONAL,
+            )
+            await show_user_data(message, state)
+
+    except TokenRefreshError as error:
+        logger.debug('Can not refresh token for user: {user_id}', user_id=message.from_user.id, event='refresh_failure')
+        await process_error_scenario(message, str(error), state)
+
+    except UserDataError as error:
+        logger.debug(
+            'Something is wrong with users {user_id} data. {error}',
+            user_id=message.from_user.id,
+            error=error,
+            event='process_failure',
+        )
+        await message_sender.send(message.from_user.id, f'Something is wrong with your data!{error.error_message}')
+        await show_user_data(message, state)
+
+
+async def process_upstream_unavailable_error(update: types.Update, error: UpstreamUnavailableError) -> bool:
+    """Fail fast when kcash API is not available instead of waiting for it"""
+    message = update.message or update.callback_query
+    logger.warning(
+        'Kcash API is not available for user {user_id}. {error}',
+        user_id=message.from_user.id,
+        error=error,
+        event='upstream_unavailable',
+    )
+    await process_error_scenario(message, error.error_message, Dispatcher.get_current().current_state())
+    return True
+
+
+def register_handlers(dispatcher: Dispatcher):
+    """Register all bot handlers in dispatcher"""
+    dispatcher.register_message_handler(process_start_command, commands='start')
+    dispatcher.register_callback_query_handler(process_start_command, state=MainForm.start)
+    dispatcher.register_message_handler(process_user_data_submission, state=MainForm.data_submission)
+    dispatcher.register_message_handler(process_main_menu_funcs, state=MainForm.work_process)
+    dispatcher.register_callback_query_handler(process_main_menu_funcs, state=MainForm.work_process)
+    dispatcher.register_errors_handler(process_upstream_unavailable_error, exception=UpstreamUnavailableError)
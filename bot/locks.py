@@ -0,0 +1,42 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from aioredis import Redis
+from loguru import logger
+
+
+class RedisLock:
+    """Lock letting only one bot process run a background job at a time. The lock expires after ttl,
+    so it is not kept forever by a process which has died, and is extended while the job runs.
+    The lock is not released when the job finishes, so other processes do not run the job again before ttl passes"""
+
+    def __init__(self, redis: Redis, key: str, ttl: float):
+        self._redis = redis
+        self._key = key
+        self._ttl = max(int(ttl), 1)
+        self._token = os.urandom(8).hex()  # Tells the lock taken by this process from locks of other ones
+
+    @asynccontextmanager
+    async def hold(self) -> AsyncIterator[bool]:
+        """Try to take the lock, get whether it is taken. The lock is extended until the block exits"""
+        if not await self._redis.set(self._key, self._token, nx=True, ex=self._ttl):
+            yield False
+            return
+        keeper = asyncio.create_task(self._keep())
+        try:
+            yield True
+        finally:
+            keeper.cancel()
+
+    async def _keep(self):
+        while True:
+            await asyncio.sleep(self._ttl / 3)
+            try:
+                if await self._redis.get(self._key) != self._token:
+                    logger.warning('Lock {key} is taken by another process', key=self._key)
+                    return
+                await self._redis.expire(self._key, self._ttl)
+            except Exception:
+                logger.exception('Cause exception while extending lock {key}', key=self._key)
@@ -0,0 +1,81 @@
+import random
+import socket
+import sys
+import threading
+from typing import Optional, Union, TextIO
+
+from loguru import logger
+
+from project_settings import settings
+
+
+class BatchedSink:
+    """Loguru sink writing messages to file or tcp socket in batches.
+    Batch is written when it is full or flush interval has passed"""
+
+    def __init__(self, destination: str, batch_size: int, flush_interval: float):
+        self._output = self._open_output(destination)
+        self._batch_size = batch_size
+        self._batch: list[str] = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval,), daemon=True)
+        self._flusher.start()
+
+    def write(self, message: str):
+        with self._lock:
+            self._batch.append(message)
+            if len(self._batch) >= self._batch_size:
+                self._write_batch()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            self._write_batch()
+        self._output.close()
+
+    def _flush_periodically(self, flush_interval: float):
+        while not self._stopped.wait(flush_interval):
+            with self._lock:
+                self._write_batch()
+
+    def _write_batch(self):
+        if not self._batch:
+            return
+        data = ''.join(self._batch)
+        self._batch.clear()
+        if isinstance(self._output, socket.socket):
+            self._output.sendall(data.encode())
+        else:
+            self._output.write(data)
+            self._output.flush()
+
+    @staticmethod
+    def _open_output(destination: str) -> Union[TextIO, socket.socket]:
+        """Open file or connect to socket given as tcp://host:port"""
+        if destination.startswith('tcp://'):
+            host, port = destination[len('tcp://'):].rsplit(':', 1)
+            return socket.create_connection((host, int(port)))
+        return open(destination, 'a', encoding='utf-8')
+
+
+def sample_records(record: dict) -> bool:
+    """Let through only configured share of records of high volume events"""
+    rate: Optional[float] = settings.logging.sampling.get(record['extra'].get('event'))
+    return rate is None or random.random() < rate
+
+
+def setup_logging():
+    """Configure logging in a background thread, so writing logs never blocks event loop"""
+    logger.remove()
+    logger.add(
+        sys.stderr if settings.logging.sink is None else BatchedSink(
+            settings.logging.sink,
+            batch_size=settings.logging.batch_size,
+            flush_interval=settings.logging.flush_interval,
+        ),
+        level=settings.logging.level,
+        serialize=settings.logging.structured,
+        filter=sample_records,
+        enqueue=True,
+    )
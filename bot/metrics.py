@@ -0,0 +1,244 @@
+import bisect
+import time
+from functools import wraps
+from typing import Optional, Callable, Awaitable, Union
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+from bot.exceptions import TgBotError
+from project_settings import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """Base of metrics exposed in prometheus text format"""
+
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+
+    def expose(self) -> list[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+
+    def _format_labels(self, label_values: tuple, **extra_labels) -> str:
+        labels = [f'{name}="{value}"' for name, value in zip(self.label_names, label_values)]
+        labels.extend(f'{name}="{value}"' for name, value in extra_labels.items())
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Counter(Metric):
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        super(Counter, self).__init__(name, documentation, label_names)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        if settings.metrics.enabled:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def expose(self) -> list[str]:
+        lines = super(Counter, self).expose()
+        lines.extend(f'{self.name}{self._format_labels(labels)} {value}' for labels, value in self._values.items())
+        return lines
+
+
+class Gauge(Metric):
+    """Gauge changed in place or, if callback is passed, got from it at the moment of scraping"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Optional[Callable[[], float]] = None):
+        super(Gauge, self).__init__(name, documentation)
+        self._callback = callback
+        self._value = 0
+
+    def inc(self, amount: float = 1):
+        if settings.metrics.enabled:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        if settings.metrics.enabled:
+            self._value -= amount
+
+    def expose(self) -> list[str]:
+        value = self._callback() if self._callback is not None else self._value
+        return super(Gauge, self).expose() + [f'{self.name} {value}']
+
+
+class Histogram(Metric):
+
+    type_name = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self._buckets = buckets
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}  # Bucket counts and sum of observations
+
+    def observe(self, value: float, *label_values):
+        if not settings.metrics.enabled:
+            return
+        values = self._values.get(label_values)
+        if values is None:
+            values = self._values[label_values] = ([0] * (len(self._buckets) + 1), [0.0])
+        bucket_counts, observations_sum = values
+        bucket_counts[bisect.bisect_left(self._buckets, value)] += 1
+        observations_sum[0] += value
+
+    def expose(self) -> list[str]:
+        lines = super(Histogram, self).expose()
+        for labels, (bucket_counts, observations_sum) in self._values.items():
+            cumulative_count = 0
+            for upper_bound, count in zip(self._buckets + ('+Inf',), bucket_counts):
+                cumulative_count += count
+                lines.append(f'{self.name}_bucket{self._format_labels(labels, le=upper_bound)} {cumulative_count}')
+            lines.append(f'{self.name}_sum{self._format_labels(labels)} {observations_sum[0]}')
+            lines.append(f'{self.name}_count{self._format_labels(labels)} {cumulative_count}')
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    def register(self, metric: Metric) -> Metric:
+        """Register metric, metric registered under the same name before is replaced by it"""
+        self._metrics[metric.name] = metric
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+    async def start_server(self, host: str, port: int):
+        """Serve metrics on local HTTP port"""
+        async def serve_metrics(_: web.Request) -> web.Response:
+            return web.Response(text=self.expose(), content_type='text/plain')
+
+        app = web.Application()
+        app.router.add_get('/metrics', serve_metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+registry = MetricsRegistry()
+
+handler_latency = registry.register(Histogram(
+    'bot_handler_latency_seconds',
+    'Time spent processing message and callback query by FSM state',
+    ('state',),
+))
+api_request_latency = registry.register(Histogram(
+    'bot_api_request_latency_seconds',
+    'Time spent on kcash API requests by endpoint and response status',
+    ('endpoint', 'status'),
+))
+api_errors = registry.register(Counter(
+    'bot_api_errors_total',
+    'Errors returned by kcash API calls by error type and code',
+    ('error', 'code'),
+))
+redis_latency = registry.register(Histogram(
+    'bot_redis_round_trip_seconds',
+    'Time spent on FSM storage round trips by operation',
+    ('operation',),
+))
+duplicate_updates = registry.register(Counter(
+    'bot_duplicate_updates_total',
+    'Redelivered updates and repeated button presses dropped by kind',
+    ('kind',),
+))
+rejected_updates = registry.register(Counter(
+    'bot_rejected_updates_total',
+    'Updates rejected because too many updates were waiting to be processed',
+))
+reclaimed_session_keys = registry.register(Counter(
+    'bot_reclaimed_session_keys_total',
+    'FSM keys of finished sessions deleted by sessions sweeper',
+))
+user_data_cache_hits = registry.register(Counter(
+    'bot_user_data_cache_hits_total',
+    'User data got from process cache',
+))
+user_data_cache_redis_hits = registry.register(Counter(
+    'bot_user_data_cache_redis_hits_total',
+    'User data got from redis cache',
+))
+user_data_cache_misses = registry.register(Counter(
+    'bot_user_data_cache_misses_total',
+    'User data requested from kcash API',
+))
+updates_in_process = registry.register(Gauge(
+    'bot_updates_in_process',
+    'Updates which are being processed now',
+))
+
+
+def register_gauge(name: str, documentation: str, callback: Callable[[], float]):
+    """Register gauge value of which is got from callback"""
+    registry.register(Gauge(name, documentation, callback))
+
+
+def count_api_errors(
+        api_func: Callable[..., Awaitable[Union[str, None, dict[str], tuple]]]
+):
+    """Count errors raised by API func by their codes. Settings are not loaded on import,
+    so the func is always wrapped and counting does nothing while metrics are disabled"""
+    @wraps(api_func)
+    async def wrapper(*args, **kwargs) -> Union[str, None, dict[str], tuple]:
+        try:
+            return await api_func(*args, **kwargs)
+        except TgBotError as error:
+            api_errors.inc(type(error).__name__, error.error_code)
+            raise
+
+    return wrapper
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Measure handlers latency and number of updates in process"""
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        updates_in_process.inc()
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        updates_in_process.dec()
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data['handler_started_at'] = time.perf_counter()
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict):
+        self._observe_handler_latency(data)
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        data['handler_started_at'] = time.perf_counter()
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results: list, data: dict):
+        self._observe_handler_latency(data)
+
+    @staticmethod
+    def _observe_handler_latency(data: dict):
+        handler_latency.observe(time.perf_counter() - data['handler_started_at'], data.get('raw_state') or 'none')
@@ -0,0 +1,99 @@
+import asyncio
+import signal
+from typing import Callable, Awaitable, Optional
+
+from aiogram import Bot, Dispatcher, types
+from loguru import logger
+
+from bot.tenants import TenantRegistry, add_tenant, get_tenant_name
+from project_settings import settings
+
+POLLING_OFFSET_KEY = 'polling:offset'
+
+
+class GracefulPolling:
+    """Long polling which on stop lets updates in process finish and saves offset of the next update,
+    so the next bot instance resumes polling from it instead of skipping updates sent during restart"""
+
+    def __init__(self, dispatcher: Dispatcher, timeout: int):
+        self._dispatcher = dispatcher
+        self._timeout = timeout
+        self._offset_key = add_tenant(POLLING_OFFSET_KEY, get_tenant_name(dispatcher))
+        self._offset: Optional[int] = None
+        self._updates_in_process: dict[asyncio.Task, int] = {}  # Id of the first update of every batch in process
+
+    async def run(self):
+        """Poll updates and process them until cancelled"""
+        Bot.set_current(self._dispatcher.bot)
+        Dispatcher.set_current(self._dispatcher)
+        await self._dispatcher.bot.delete_webhook()
+        redis = await self._dispatcher.storage.redis()
+        saved_offset = await redis.get(self._offset_key)
+        if saved_offset is not None:
+            self._offset = int(saved_offset)
+            logger.info('Resuming polling from update {offset}', offset=self._offset)
+        else:  # The very first start, updates sent before it are skipped
+            updates = await self._dispatcher.bot.get_updates(offset=-1, timeout=1)
+            self._offset = updates[-1].update_id + 1 if updates else None
+
+        while True:
+            try:
+                updates = await self._dispatcher.bot.get_updates(offset=self._offset, timeout=self._timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Cause exception while getting updates')
+                await asyncio.sleep(5)
+                continue
+            if updates:
+                self._offset = updates[-1].update_id + 1
+                task = asyncio.create_task(self._process_updates(updates))
+                self._updates_in_process[task] = updates[0].update_id
+                task.add_done_callback(self._updates_in_process.pop)
+
+    async def drain(self, timeout: float):
+        """Wait for updates in process up to timeout and save offset to resume polling from,
+        if some batches are cancelled polling resumes from the first of them"""
+        offset = self._offset
+        if self._updates_in_process:
+            _, pending = await asyncio.wait(set(self._updates_in_process), timeout=timeout)
+            if pending:
+                offset = min(self._updates_in_process[task] for task in pending)
+                logger.warning('Processing of {count} update batches was cancelled on shutdown', count=len(pending))
+            for task in pending:
+                task.cancel()
+        if offset is not None:
+            redis = await self._dispatcher.storage.redis()
+            await redis.set(self._offset_key, offset)
+
+    async def _process_updates(self, updates: list[types.Update]):
+        try:
+            await self._dispatcher.process_updates(updates)
+        except Exception:
+            logger.exception('Cause exception while processing updates')
+
+
+def start_polling(
+        tenants: TenantRegistry,
+        on_startup: Callable[[list[Dispatcher]], Awaitable],
+        on_shutdown: Callable[[list[Dispatcher]], Awaitable],
+):
+    """Start all bots in long polling mode, SIGTERM and SIGINT stop polling and drain updates in process"""
+    loop = asyncio.get_event_loop()
+    dispatchers = list(tenants)
+    pollings = [GracefulPolling(dispatcher, timeout=settings.polling.timeout) for dispatcher in dispatchers]
+    loop.run_until_complete(on_startup(dispatchers))
+    polling_task = asyncio.gather(*(loop.create_task(polling.run()) for polling in pollings))
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, polling_task.cancel)
+    try:
+        loop.run_until_complete(polling_task)
+    except asyncio.CancelledError:
+        logger.warning('Polling is stopped, draining updates in process')
+    finally:
+        loop.run_until_complete(asyncio.gather(
+            *(polling.drain(settings.polling.drain_timeout) for polling in pollings)
+        ))
+        loop.run_until_complete(on_shutdown(dispatchers))
+        for dispatcher in dispatchers:
+            loop.run_until_complete(dispatcher.bot.close())
@@ -0,0 +1,78 @@
+from typing import Any, Callable
+
+from aiohttp import ClientResponse
+
+from bot.constants import Codes, Currency
+from bot.exceptions import (
+    AuthenticationError,
+    TokenRefreshError,
+    TWOFArequiredError,
+    UserDataError,
+)
+
+try:  # Optional faster decoder
+    import orjson
+    loads: Callable[[bytes], Any] = orjson.loads
+except ImportError:
+    import ujson
+    loads = ujson.loads
+
+ERROR_MARKER = b'"error"'
+
+
+async def read_response(
+        response: ClientResponse,
+        request_type_code: str = Codes.AUTHORIZED_REQUEST.value,
+) -> dict[str, Any]:
+    """Decode response body once and raise error it contains"""
+    result = loads(await response.read())
+    _raise_for_error(result, request_type_code)
+    return result
+
+
+async def check_response(response: ClientResponse):
+    """Raise error contained in response whose body is not needed, body without error is not decoded"""
+    if response.content_type != 'application/json':
+        return
+    body = await response.read()
+    if ERROR_MARKER in body:
+        _raise_for_error(loads(body), Codes.AUTHORIZED_REQUEST.value)
+
+
+async def read_tokens(
+        response: ClientResponse,
+        request_type_code: str = Codes.AUTHORIZED_REQUEST.value,
+) -> dict[str, str]:
+    result = await read_response(response, request_type_code)
+    return {'refreshToken': result['refreshToken'], 'accessToken': result['accessToken']}
+
+
+async def read_balance_info(response: ClientResponse) -> list[Currency]:
+    """Get all user currencies and their amount"""
+    return [
+        Currency(wallet.get('currencyName'), wallet.get('availableFunds'))
+        for wallet in (await read_response(response))['wallets']
+    ]
+
+
+async def read_username(response: ClientResponse) -> str:
+    return (await read_response(response))['userName']
+
+
+def _raise_for_error(result: dict[str, Any], request_type_code: str):
+    """Check if error occurred during request"""
+    error = result.get('error') if isinstance(result, dict) else None
+    if error is None:
+        return
+    error_code, error_message = error['messageCode'], error['message']
+
+    if request_type_code == Codes.TOKEN_REFRESH_REQUEST.value:
+        raise TokenRefreshError(error_message, error_code)
+
+    elif error_code == 126:
+        raise TWOFArequiredError(error_message, error_code)
+
+    elif error_code == 171:
+        raise AuthenticationError(error_message, error_code)
+
+    raise UserDataError(error_message, error_code)
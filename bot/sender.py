@@ -0,0 +1,196 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+from loguru import logger
+
+from bot.constants import MessagePriority
+from bot.tracing import Span, tracer
+
+MAX_MESSAGE_LENGTH = 4096
+
+ChatAddress = tuple[Bot, int]  # Bot sending to chat and chat id
+
+
+class TokenBucket:
+    """Token bucket allowing given rate of actions per second with bursts up to capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def delay(self) -> float:
+        """Get time to wait before the next action is allowed"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class OutgoingMessage:
+
+    __slots__ = ('text', 'reply_markup', 'priority', 'span')
+
+    def __init__(self, text: str, reply_markup: Optional[str], priority: MessagePriority,
+                 span: Optional[Span] = None):
+        self.text = text
+        self.reply_markup = reply_markup
+        self.priority = priority
+        self.span = span  # Span of the update which has sent the message
+
+
+class MessageSender:
+    """Queue of outgoing messages sent in order for every chat within global and per chat flood limits.
+    Interactive replies are sent before informational messages and consecutive queued messages
+    to one chat are joined into one message. Messages are sent by the bot current in the context,
+    every bot has its own flood limits"""
+
+    def __init__(self, chat_buckets_limit: int = 10000):
+        self._bot: Optional[Bot] = None
+        self._global_rate = 0.0
+        self._global_buckets: dict[Bot, TokenBucket] = {}
+        self._chat_rate = 0.0
+        self._chat_burst = 0.0
+        self._chat_buckets_limit = chat_buckets_limit
+        self._chat_buckets: OrderedDict[ChatAddress, TokenBucket] = OrderedDict()
+        self._queues: dict[ChatAddress, deque[OutgoingMessage]] = {}  # Chats which are waiting to send or sending now
+        self._ready: Optional[asyncio.PriorityQueue] = None
+        self._order = itertools.count()
+        self._worker: Optional[asyncio.Task] = None
+        self._deliveries: set[asyncio.Task] = set()
+
+    async def start(self, bot: Bot, global_rate: float, chat_rate: float, chat_burst: float):
+        """Start sending queued messages, given bot sends messages queued outside of bot context"""
+        self._bot = bot
+        self._global_rate = global_rate
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._ready = asyncio.PriorityQueue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float):
+        """Wait for queued messages to be sent and stop sending"""
+        deadline = time.monotonic() + timeout
+        while self._queues and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._queues:
+            logger.warning('Messages to {chats} chats were not sent before shutdown', chats=len(self._queues))
+        if self._worker is not None:
+            self._worker.cancel()
+        for delivery in self._deliveries:
+            delivery.cancel()
+
+    async def send(
+            self,
+            chat_id: int,
+            text: str,
+            reply_markup: Optional[str] = None,
+            priority: MessagePriority = MessagePriority.INTERACTIVE,
+    ):
+        """Queue message to be sent to chat"""
+        message = OutgoingMessage(text, reply_markup, priority, tracer.current_span())
+        chat = (Bot.get_current() or self._bot, chat_id)
+        queue = self._queues.get(chat)
+        if queue is not None:
+            queue.append(message)
+            return
+        self._queues[chat] = deque((message,))
+        self._schedule(chat)
+
+    def queue_size(self) -> int:
+        return sum(map(len, self._queues.values()))
+
+    def _schedule(self, chat: ChatAddress):
+        """Put chat in line for sending its first queued message"""
+        self._ready.put_nowait((self._queues[chat][0].priority, next(self._order), chat))
+
+    async def _run(self):
+        while True:
+            _, _, chat = await self._ready.get()
+            chat_bucket = self._get_chat_bucket(chat)
+            chat_delay = chat_bucket.delay()
+            if chat_delay:
+                asyncio.get_running_loop().call_later(chat_delay, self._schedule, chat)
+                continue
+
+            global_bucket = self._get_global_bucket(chat[0])
+            global_delay = global_bucket.delay()
+            if global_delay:
+                await asyncio.sleep(global_delay)
+                global_bucket.delay()
+            global_bucket.consume()
+            chat_bucket.consume()
+
+            delivery = asyncio.create_task(self._deliver(chat, self._pop_joined_message(self._queues[chat])))
+            self._deliveries.add(delivery)
+            delivery.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat: ChatAddress, message: OutgoingMessage):
+        bot, chat_id = chat
+        try:
+            with tracer.activate(message.span):
+                await bot.send_message(chat_id, message.text, reply_markup=message.reply_markup)
+        except RetryAfter as error:
+            logger.warning(
+                'Flood control exceeded for chat {chat_id}, retry in {timeout} seconds',
+                chat_id=chat_id,
+                timeout=error.timeout,
+                event='flood_control',
+            )
+            self._queues[chat].appendleft(message)
+            asyncio.get_running_loop().call_later(error.timeout, self._schedule, chat)
+            return
+        except Exception:  # Including timeouts and connection errors not wrapped by aiogram, chat is not stuck by them
+            logger.exception('Can not send message to chat {chat_id}', chat_id=chat_id, event='send_failure')
+
+        if self._queues[chat]:
+            self._schedule(chat)
+        else:
+            del self._queues[chat]
+
+    def _get_global_bucket(self, bot: Bot) -> TokenBucket:
+        global_bucket = self._global_buckets.get(bot)
+        if global_bucket is None:
+            global_bucket = self._global_buckets[bot] = TokenBucket(self._global_rate, self._global_rate)
+        return global_bucket
+
+    def _get_chat_bucket(self, chat: ChatAddress) -> TokenBucket:
+        chat_bucket = self._chat_buckets.get(chat)
+        if chat_bucket is None:
+            chat_bucket = self._chat_buckets[chat] = TokenBucket(self._chat_rate, self._chat_burst)
+            if len(self._chat_buckets) > self._chat_buckets_limit:
+                self._chat_buckets.popitem(last=False)
+        self._chat_buckets.move_to_end(chat)
+        return chat_bucket
+
+    @staticmethod
+    def _pop_joined_message(queue: deque[OutgoingMessage]) -> OutgoingMessage:
+        """Pop first queued message joined with the following ones while they fit in one message"""
+        message = queue.popleft()
+        while (
+                queue and
+                message.reply_markup is None and
+                len(message.text) + len(queue[0].text) + 2 <= MAX_MESSAGE_LENGTH
+        ):
+            next_message = queue.popleft()
+            message = OutgoingMessage(
+                f'{message.text}\n\n{next_message.text}',
+                next_message.reply_markup,
+                min(message.priority, next_message.priority),
+                message.span,
+            )
+        return message
+
+
+message_sender = MessageSender()
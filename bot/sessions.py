@@ -0,0 +1,108 @@
+import asyncio
+from typing import Optional
+
+from aiogram import Dispatcher
+from aiogram.contrib.fsm_storage.redis import STATE_KEY
+from loguru import logger
+
+from bot.locks import RedisLock
+from bot.metrics import reclaimed_session_keys
+from bot.storage import BufferedRedisStorage
+
+
+class SessionSweeper:
+    """Walk FSM keys in background giving expiry of their session state to keys left without it
+    and deleting keys of users who have no state anymore. Only one bot process sweeps at a time,
+    FSM keys of every bot hosted by the process are swept by one worker"""
+
+    def __init__(self, prefix: str = 'session_sweeper'):
+        self._storages: list[BufferedRedisStorage] = []
+        self._interval = 0.0
+        self._batch_size = 0
+        self._lock_key = f'{prefix}:lock'
+        self._worker: Optional[asyncio.Task] = None
+
+    async def start(self, dispatcher: Dispatcher, interval: float, batch_size: int):
+        self._storages.append(dispatcher.storage)
+        self._interval = interval
+        self._batch_size = batch_size
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+
+    async def sweep(self) -> tuple[int, int]:
+        """Sweep all FSM keys once, return numbers of deleted keys and keys given expiry"""
+        reclaimed = expiring = 0
+        for storage in self._storages:
+            redis = await storage.redis()
+            nested_prefixes = self._get_nested_prefixes(storage)
+            cursor = None
+            while cursor != 0:
+                cursor, keys = await redis.scan(cursor or 0, match=storage.generate_key('*'), count=self._batch_size)
+                keys = [key for key in keys if not key.startswith(nested_prefixes)]
+                if keys:
+                    deleted, expired = await self._sweep_keys(storage, keys)
+                    reclaimed, expiring = reclaimed + deleted, expiring + expired
+        reclaimed_session_keys.inc(amount=reclaimed)
+        return reclaimed, expiring
+
+    def _get_nested_prefixes(self, storage: BufferedRedisStorage) -> tuple[str, ...]:
+        """Get key prefixes of other storages nested in the prefix of given one, like tenant storages
+        in the main bot one, their keys are swept with their own storage"""
+        prefix = storage.generate_key('')
+        return tuple(
+            other.generate_key('') for other in self._storages
+            if other is not storage and other.generate_key('').startswith(prefix)
+        )
+
+    async def _run(self):
+        lock = RedisLock(await self._storages[0].redis(), self._lock_key, ttl=self._interval)
+        while True:
+            async with lock.hold() as is_taken:
+                if is_taken:
+                    try:
+                        reclaimed, expiring = await self.sweep()
+                        logger.info(
+                            'Sessions sweep has reclaimed {reclaimed} keys and set expiry of {expiring} keys',
+                            reclaimed=reclaimed,
+                            expiring=expiring,
+                            event='sessions_sweep',
+                        )
+                    except Exception:
+                        logger.exception('Cause exception while sweeping sessions')
+            await asyncio.sleep(self._interval)
+
+    @staticmethod
+    async def _sweep_keys(storage: BufferedRedisStorage, keys: list[str]) -> tuple[int, int]:
+        """Handle keys which do not expire, they are written before session expiry was set up"""
+        redis = await storage.redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.ttl(key)
+            ttls = await pipe.execute()
+        persistent_keys = [key for key, ttl in zip(keys, ttls) if ttl == -1]
+        if not persistent_keys:
+            return 0, 0
+
+        sessions = list({key.rsplit(':', 1)[0] for key in persistent_keys})
+        states = dict(zip(sessions, await redis.mget([f'{session}:{STATE_KEY}' for session in sessions])))
+        deleted_keys, expiring_keys = [], []
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in persistent_keys:
+                state = states[key.rsplit(':', 1)[0]]
+                ttl = storage.get_session_ttl(state)
+                if state is None:
+                    deleted_keys.append(key)
+                elif ttl is not None:
+                    pipe.expire(key, ttl)
+                    expiring_keys.append(key)
+            if deleted_keys:
+                pipe.delete(*deleted_keys)
+            await pipe.execute()
+        return len(deleted_keys), len(expiring_keys)
+
+
+session_sweeper = SessionSweeper()
@@ -0,0 +1,430 @@
+import asyncio
+import copy
+import time
+import typing
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from aiogram import types
+from aiogram.contrib.fsm_storage.redis import RedisStorage2, STATE_KEY, STATE_DATA_KEY
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils import json
+from loguru import logger
+
+from bot.metrics import redis_latency
+from bot.tracing import tracer
+from bot.workers import UserLocks, get_update_user_id
+
+STATE_FIELDS_KEY = 'fields'
+
+_state_buffer: ContextVar[typing.Optional[dict]] = ContextVar('state_buffer', default=None)
+
+
+class StateRecord:
+    """State and data of one user loaded from redis during an update.
+    Snapshot keeps data as it is stored in redis, if it is unknown data is rewritten completely"""
+
+    __slots__ = ('state', 'data', 'snapshot', 'is_state_changed', 'is_data_changed')
+
+    def __init__(self, state: typing.Optional[str], data: dict, snapshot: typing.Optional[dict] = None):
+        self.state = state
+        self.data = data
+        self.snapshot = snapshot
+        self.is_state_changed = False
+        self.is_data_changed = False
+
+
+class BufferedRedisStorage(RedisStorage2):
+    """Redis storage which loads user state and data once per update and writes all changes
+    back in one redis transaction at the end of the update, see StateBufferMiddleware.
+    Outside of an update every call goes to redis at once.
+    Keys of user session expire after TTL of its state, which is prolonged by every update of user.
+    Storage may use connection pool of another storage, the pool is closed by its owner then"""
+
+    data_key_name = STATE_DATA_KEY
+
+    def __init__(self, *args, session_ttls: typing.Optional[dict[str, int]] = None,
+                 default_session_ttl: typing.Optional[int] = None,
+                 pool_owner: typing.Optional[RedisStorage2] = None, **kwargs):
+        super(BufferedRedisStorage, self).__init__(*args, **kwargs)
+        self._session_ttls = session_ttls or {}
+        self._default_session_ttl = default_session_ttl
+        self._pool_owner = pool_owner
+
+    async def _get_adapter(self):
+        if self._pool_owner is not None:
+            return await self._pool_owner._get_adapter()
+        return await super(BufferedRedisStorage, self)._get_adapter()
+
+    def get_session_ttl(self, state: typing.Optional[str]) -> typing.Optional[int]:
+        """Get expiry of session keys by state of session, None if they do not expire"""
+        return self._session_ttls.get(state, self._default_session_ttl)
+
+    async def get_state(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self._get_record(chat, user)
+        if record is None:
+            return await super(BufferedRedisStorage, self).get_state(chat=chat, user=user, default=default)
+        return record.state or self.resolve_state(default)
+
+    async def get_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._get_record(chat, user)
+        if record is None:
+            record = await self._load_record(*self.check_address(chat=chat, user=user))
+            return record.data or default or {}
+        return copy.deepcopy(record.data) if record.data else default or {}
+
+    async def set_state(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        record = await self._get_record(chat, user)
+        if record is None:
+            record = StateRecord(None if state is None else self.resolve_state(state), {})
+            record.is_state_changed = True
+            return await self._write_records([(self.check_address(chat=chat, user=user), record)])
+        record.state = None if state is None else self.resolve_state(state)
+        record.is_state_changed = True
+
+    async def set_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        record = await self._get_record(chat, user)
+        if record is None:
+            record = StateRecord(None, {})
+            record.data, record.is_data_changed = data or {}, True
+            return await self._write_records([(self.check_address(chat=chat, user=user), record)])
+        record.data = copy.deepcopy(data) if data else {}
+        record.is_data_changed = True
+
+    async def flush(self, buffer: dict):
+        """Write all changed states and data of the buffer and prolong expiry of the rest in one transaction"""
+        loaded_records = [
+            (address, loading.result()) for address, loading in buffer.items()
+            if loading.done() and not loading.cancelled() and loading.exception() is None
+        ]
+        records = [
+            (address, record) for address, record in loaded_records
+            if record.is_state_changed or record.is_data_changed or self.get_session_ttl(record.state) is not None
+        ]
+        if records:
+            await self._write_records(records)
+
+    async def _write_records(self, records: list[tuple[tuple[str, str], StateRecord]]):
+        """Save changes of records in one transaction"""
+        redis = await (await self._get_adapter()).get_redis()
+        async with redis.pipeline(transaction=True) as pipe:
+            for (chat, user), record in records:
+                ttl = self.get_session_ttl(record.state)
+                if record.is_state_changed:
+                    self._write_state(pipe, chat, user, record, ttl)
+                if record.is_data_changed:
+                    self._write_data(pipe, chat, user, record, ttl)
+                if ttl is not None:
+                    self._prolong_session(pipe, chat, user, record, ttl)
+            started_at = time.perf_counter()
+            with tracer.span('redis write', records=len(records)):
+                await pipe.execute()
+        redis_latency.observe(time.perf_counter() - started_at, 'write')
+
+    def _write_state(self, pipe, chat: str, user: str, record: StateRecord, ttl: typing.Optional[int]):
+        """Add commands saving record state to pipeline"""
+        state_key = self.generate_key(chat, user, STATE_KEY)
+        if record.state is None:
+            pipe.delete(state_key)
+        else:
+            pipe.set(state_key, record.state, ex=ttl or self._state_ttl)
+
+    def _write_data(self, pipe, chat: str, user: str, record: StateRecord, ttl: typing.Optional[int]):
+        """Add commands saving record data to pipeline"""
+        data_key = self.generate_key(chat, user, STATE_DATA_KEY)
+        if record.data:
+            pipe.set(data_key, json.dumps(record.data), ex=ttl or self._data_ttl)
+        else:
+            pipe.delete(data_key)
+
+    def _prolong_session(self, pipe, chat: str, user: str, record: StateRecord, ttl: int):
+        """Add commands resetting expiry of session keys which are not rewritten to pipeline"""
+        if record.state is not None and not record.is_state_changed:
+            pipe.expire(self.generate_key(chat, user, STATE_KEY), ttl)
+        if record.data and not record.is_data_changed:
+            pipe.expire(self.generate_key(chat, user, self.data_key_name), ttl)
+
+    async def _get_record(self, chat: typing.Union[str, int, None],
+                          user: typing.Union[str, int, None]) -> typing.Optional[StateRecord]:
+        """Get record of user from current update buffer, loading it on first access"""
+        buffer = _state_buffer.get()
+        if buffer is None:
+            return None
+        address = self.check_address(chat=chat, user=user)
+        loading = buffer.get(address)
+        if loading is None:
+            loading = buffer[address] = asyncio.ensure_future(self._load_record(*address))
+        return await asyncio.shield(loading)
+
+    async def _load_record(self, chat: str, user: str) -> StateRecord:
+        """Load state and data of user with one request"""
+        redis = await (await self._get_adapter()).get_redis()
+        started_at = time.perf_counter()
+        with tracer.span('redis load'):
+            state, raw_data = await redis.mget(
+                self.generate_key(chat, user, STATE_KEY),
+                self.generate_key(chat, user, STATE_DATA_KEY),
+            )
+        redis_latency.observe(time.perf_counter() - started_at, 'load')
+        return StateRecord(state, json.loads(raw_data) if raw_data else {})
+
+
+class HashRedisStorage(BufferedRedisStorage):
+    """Buffered storage keeping user data in redis hash with a field per data key,
+    so only changed fields are written. Data saved as one json value is migrated on first access"""
+
+    data_key_name = STATE_FIELDS_KEY
+
+    async def _load_record(self, chat: str, user: str) -> StateRecord:
+        redis = await (await self._get_adapter()).get_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.generate_key(chat, user, STATE_KEY))
+            pipe.hgetall(self.generate_key(chat, user, STATE_FIELDS_KEY))
+            pipe.get(self.generate_key(chat, user, STATE_DATA_KEY))
+            started_at = time.perf_counter()
+            with tracer.span('redis load'):
+                state, fields, legacy_raw_data = await pipe.execute()
+        redis_latency.observe(time.perf_counter() - started_at, 'load')
+
+        if fields:
+            return StateRecord(state, {field: json.loads(value) for field, value in fields.items()}, snapshot=fields)
+
+        record = StateRecord(state, json.loads(legacy_raw_data) if legacy_raw_data else {}, snapshot={})
+        record.is_data_changed = bool(legacy_raw_data)
+        return record
+
+    def _write_data(self, pipe, chat: str, user: str, record: StateRecord, ttl: typing.Optional[int]):
+        fields_key = self.generate_key(chat, user, STATE_FIELDS_KEY)
+        fields = {field: json.dumps(value) for field, value in record.data.items()}
+        if record.snapshot is None:
+            pipe.delete(fields_key)
+        elif not record.snapshot:  # Drop data left in json format
+            pipe.delete(self.generate_key(chat, user, STATE_DATA_KEY))
+
+        snapshot = record.snapshot or {}
+        removed_fields = [field for field in snapshot if field not in fields]
+        changed_fields = {field: value for field, value in fields.items() if snapshot.get(field) != value}
+        if removed_fields:
+            pipe.hdel(fields_key, *removed_fields)
+        if changed_fields:
+            pipe.hset(fields_key, mapping=changed_fields)
+        if record.data and (ttl or self._data_ttl):
+            pipe.expire(fields_key, ttl or self._data_ttl)
+
+
+class SessionShard:
+    """Part of in memory sessions with their least recently used order,
+    sessions waiting to be written, sessions being written now and sessions read since the last flush"""
+
+    __slots__ = ('records', 'dirty', 'writing', 'touched')
+
+    def __init__(self):
+        self.records: OrderedDict[tuple[str, str], StateRecord] = OrderedDict()
+        self.dirty: set[tuple[str, str]] = set()
+        self.writing: set[tuple[str, str]] = set()
+        self.touched: set[tuple[str, str]] = set()
+
+
+class MemoryRedisStorage(BufferedRedisStorage):
+    """Storage keeping user states and data in memory sharded by user. Changes are written behind to redis
+    in batches every flush interval and on close, sessions missing in memory are loaded from redis.
+    Memory is the source of truth, so the bot has to run as a single process"""
+
+    def __init__(self, *args, shards: int = 16, max_sessions: int = 100000, flush_interval: float = 1,
+                 flush_batch_size: int = 500, **kwargs):
+        super(MemoryRedisStorage, self).__init__(*args, **kwargs)
+        self._shards = tuple(SessionShard() for _ in range(shards))
+        self._max_shard_sessions = max(max_sessions // shards, 1)
+        self._flush_interval = flush_interval
+        self._flush_batch_size = flush_batch_size
+        self._loading: dict[tuple[str, str], asyncio.Future] = {}
+        self._writer: typing.Optional[asyncio.Task] = None
+
+    async def get_state(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        address, record = await self._get_session(chat, user)
+        self._mark_touched(address)
+        return record.state or self.resolve_state(default)
+
+    async def get_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        address, record = await self._get_session(chat, user)
+        self._mark_touched(address)
+        return copy.deepcopy(record.data) if record.data else default or {}
+
+    async def set_state(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        address, record = await self._get_session(chat, user)
+        record.state = None if state is None else self.resolve_state(state)
+        record.is_state_changed = True
+        self._mark_dirty(address)
+
+    async def set_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        address, record = await self._get_session(chat, user)
+        record.data = copy.deepcopy(data) if data else {}
+        record.is_data_changed = True
+        self._mark_dirty(address)
+
+    async def flush(self, buffer: dict):
+        """Nothing is buffered per update, changes are written behind"""
+
+    async def flush_sessions(self):
+        """Write changed sessions to redis in batches, sessions are not evicted while they are written.
+        Expiry of sessions which were only read is reset in batches too"""
+        for shard in self._shards:
+            written = set()
+            while shard.dirty:
+                batch = [shard.dirty.pop() for _ in range(min(len(shard.dirty), self._flush_batch_size))]
+                written.update(batch)
+                changes = [
+                    (address, self._take_changes(shard.records[address]))
+                    for address in batch if address in shard.records
+                ]
+                shard.writing.update(batch)
+                try:
+                    await self._write_records(changes)
+                except BaseException:  # Including cancellation on close, changes are written by the last flush
+                    for address, change in changes:
+                        record = shard.records.get(address)
+                        if record is None:  # Sessions were reset meanwhile
+                            continue
+                        record.is_state_changed |= change.is_state_changed
+                        record.is_data_changed |= change.is_data_changed
+                        shard.dirty.add(address)
+                    raise
+                finally:
+                    shard.writing.difference_update(batch)
+            await self._prolong_touched(shard, written)
+
+    async def close(self):
+        if self._writer is not None:  # Batch taken by the writer is returned before the last flush
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+        await self.flush_sessions()
+        await super(MemoryRedisStorage, self).close()
+
+    async def reset_all(self, full=True):
+        for shard in self._shards:
+            shard.records.clear()
+            shard.dirty.clear()
+            shard.touched.clear()
+        await super(MemoryRedisStorage, self).reset_all(full)
+
+    async def _get_session(self, chat: typing.Union[str, int, None],
+                           user: typing.Union[str, int, None]) -> tuple[tuple[str, str], StateRecord]:
+        """Get session of user from memory, loading it from redis on miss"""
+        chat, user = self.check_address(chat=chat, user=user)
+        address = (str(chat), str(user))
+        shard = self._get_shard(address)
+        record = shard.records.get(address)
+        if record is not None:
+            shard.records.move_to_end(address)
+            return address, record
+        loading = self._loading.get(address)
+        if loading is None:
+            loading = self._loading[address] = asyncio.ensure_future(self._rehydrate(address))
+        loaded_record = await asyncio.shield(loading)
+        # Session is put in memory by the caller itself, so it is not evicted before the caller changes it.
+        # Another caller may have put it already, or it may be evicted after the load if nobody changed it
+        record = shard.records.get(address)
+        if record is None:
+            self._evict(shard)
+            record = shard.records[address] = loaded_record
+        return address, record
+
+    async def _rehydrate(self, address: tuple[str, str]) -> StateRecord:
+        try:
+            return await self._load_record(*address)
+        finally:
+            del self._loading[address]
+
+    def _evict(self, shard: SessionShard):
+        """Free place for a new session dropping least recently used ones,
+        changed sessions are kept until written"""
+        excess = len(shard.records) + 1 - self._max_shard_sessions
+        if excess <= 0:
+            return
+        cold_addresses = []
+        for address in shard.records:
+            if len(cold_addresses) == excess:
+                break
+            if address not in shard.dirty and address not in shard.writing:
+                cold_addresses.append(address)
+        for address in cold_addresses:
+            del shard.records[address]
+
+    async def _prolong_touched(self, shard: SessionShard, written: set[tuple[str, str]]):
+        """Reset expiry of sessions read since the last flush, written sessions are prolonged by the write"""
+        touched = []
+        for address in shard.touched - written:
+            record = shard.records.get(address)
+            if record is not None and self.get_session_ttl(record.state) is not None:
+                touched.append((address, StateRecord(record.state, record.data)))  # Unchanged copy is only prolonged
+        shard.touched.clear()
+        for start in range(0, len(touched), self._flush_batch_size):
+            await self._write_records(touched[start:start + self._flush_batch_size])
+
+    def _mark_dirty(self, address: tuple[str, str]):
+        self._get_shard(address).dirty.add(address)
+        self._start_writer()
+
+    def _mark_touched(self, address: tuple[str, str]):
+        self._get_shard(address).touched.add(address)
+        self._start_writer()
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_behind())
+
+    async def _write_behind(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush_sessions()
+            except Exception:
+                logger.exception('Cause exception while writing sessions to redis')
+
+    def _get_shard(self, address: tuple[str, str]) -> SessionShard:
+        return self._shards[hash(address) % len(self._shards)]
+
+    @staticmethod
+    def _take_changes(record: StateRecord) -> StateRecord:
+        """Copy of record to be written, the record itself is marked as written"""
+        change = StateRecord(record.state, record.data)
+        change.is_state_changed, change.is_data_changed = record.is_state_changed, record.is_data_changed
+        record.is_state_changed = record.is_data_changed = False
+        return change
+
+
+class StateBufferMiddleware(BaseMiddleware):
+    """Buffer FSM storage access for every update and flush changes when update is processed.
+    Update of a user has to load state after the previous update of the user has flushed it, otherwise changes
+    of one of them are lost. Unless updates of one user are serialized by admission control, they are serialized here"""
+
+    def __init__(self, serialize_users: bool = True):
+        self._user_locks = UserLocks() if serialize_users else None
+        super(StateBufferMiddleware, self).__init__()
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data['state_buffer_token'] = _state_buffer.set({})
+
+    async def on_process_update(self, update: types.Update, data: dict):
+        user_id = get_update_user_id(update)
+        if self._user_locks is not None and user_id is not None:
+            await self._user_locks.acquire(user_id)
+            data['state_buffer_user_id'] = user_id
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        buffer = _state_buffer.get()
+        _state_buffer.reset(data['state_buffer_token'])
+        try:
+            await self.manager.dispatcher.storage.flush(buffer)
+        finally:
+            if 'state_buffer_user_id' in data:
+                self._user_locks.release(data['state_buffer_user_id'])
@@ -0,0 +1,40 @@
+from typing import Iterator, Optional
+
+from aiogram import Dispatcher
+
+TENANT_KEY = 'tenant'
+
+
+def get_tenant_name(dispatcher: Optional[Dispatcher] = None) -> str:
+    """Get tenant of given or current dispatcher, the main bot has empty name"""
+    dispatcher = dispatcher or Dispatcher.get_current()
+    return dispatcher.get(TENANT_KEY, '') if dispatcher is not None else ''
+
+
+def add_tenant(key: str, tenant: str) -> str:
+    """Namespace redis key or prefix by tenant, keys of the main bot are left as they are"""
+    return f'{key}:{tenant}' if tenant else key
+
+
+class TenantRegistry:
+    """Dispatchers of all bots hosted by the process by their tenant names"""
+
+    def __init__(self):
+        self._dispatchers: dict[str, Dispatcher] = {}
+
+    def add(self, dispatcher: Dispatcher, tenant: str = ''):
+        dispatcher[TENANT_KEY] = tenant
+        self._dispatchers[tenant] = dispatcher
+
+    def get(self, tenant: str) -> Optional[Dispatcher]:
+        return self._dispatchers.get(tenant)
+
+    @property
+    def main(self) -> Dispatcher:
+        return self._dispatchers['']
+
+    def __iter__(self) -> Iterator[Dispatcher]:
+        return iter(self._dispatchers.values())
+
+    def __len__(self) -> int:
+        return len(self._dispatchers)
@@ -0,0 +1,233 @@
+import asyncio
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+import ujson
+from aiogram import Bot, types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import ClientSession, ClientError
+from loguru import logger
+
+from bot.workers import get_update_user_id
+
+SERVER_SPAN_KIND, CLIENT_SPAN_KIND = 2, 3
+ERROR_STATUS_CODE = 2
+
+_current_span: ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+
+
+class Span:
+    """Timed operation of a traced update, spans without parent are traces roots"""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'started_at', 'ended_at', 'is_error')
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str, attributes: dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time_ns()
+        self.ended_at = 0
+        self.is_error = False
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_json_line(self) -> str:
+        return ujson.dumps({
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': (self.ended_at - self.started_at) / 1e6,
+            'attributes': self.attributes,
+            'error': self.is_error,
+        }) + '\n'
+
+    def to_otlp(self) -> dict[str, Any]:
+        """Convert span to OTLP/HTTP json encoding"""
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'kind': SERVER_SPAN_KIND if self.parent_id is None else CLIENT_SPAN_KIND,
+            'startTimeUnixNano': str(self.started_at),
+            'endTimeUnixNano': str(self.ended_at),
+            'attributes': [{'key': key, 'value': _to_otlp_value(value)} for key, value in self.attributes.items()],
+            'status': {'code': ERROR_STATUS_CODE} if self.is_error else {},
+        }
+
+
+def _to_otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class SpanExporter:
+    """Export finished spans in batches in background to json lines file or to OTLP/HTTP collector
+    if destination is its url. Spans over max queue size are dropped while exporting is slow or fails"""
+
+    def __init__(self, destination: str, batch_size: int, flush_interval: float, max_queue_size: int,
+                 service_name: str):
+        self._destination = destination
+        self._is_otlp = destination.startswith(('http://', 'https://'))
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_queue_size = max_queue_size
+        self._service_name = service_name
+        self._spans: list[Span] = []
+        self._dropped = 0
+        self._session: Optional[ClientSession] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._is_otlp:
+            self._session = ClientSession(json_serialize=ujson.dumps)
+        self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+        while self._spans:
+            await self.flush()
+        if self._session is not None:
+            await self._session.close()
+
+    def add(self, span: Span):
+        if len(self._spans) >= self._max_queue_size:
+            self._dropped += 1
+            return
+        self._spans.append(span)
+
+    async def flush(self):
+        """Export one batch of queued spans"""
+        batch, self._spans = self._spans[:self._batch_size], self._spans[self._batch_size:]
+        if not batch:
+            return
+        try:
+            if self._is_otlp:
+                await self._post(batch)
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+        except (ClientError, asyncio.TimeoutError, OSError) as error:
+            logger.warning('Can not export {count} spans. {error}', count=len(batch), error=error)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            if self._dropped:
+                logger.warning('{count} spans were dropped as export queue was full', count=self._dropped)
+                self._dropped = 0
+            while len(self._spans) >= self._batch_size:
+                await self.flush()
+            await self.flush()
+
+    def _write(self, batch: list[Span]):
+        with open(self._destination, 'a', encoding='utf-8') as output:
+            output.write(''.join(span.to_json_line() for span in batch))
+
+    async def _post(self, batch: list[Span]):
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self._service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'bot'}, 'spans': [span.to_otlp() for span in batch]}],
+        }]}
+        async with self._session.post(self._destination, json=payload, timeout=10) as response:
+            response.raise_for_status()
+
+
+class Tracer:
+    """Trace sampled updates. Spans are children of the span current in the context,
+    so operations run outside of a traced update are not traced"""
+
+    def __init__(self):
+        self._exporter: Optional[SpanExporter] = None
+        self._sample_rate = 0.0
+
+    async def start(self, exporter: SpanExporter, sample_rate: float):
+        self._exporter = exporter
+        self._sample_rate = sample_rate
+        await exporter.start()
+
+    async def close(self):
+        if self._exporter is not None:
+            await self._exporter.close()
+            self._exporter = None
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        return _current_span.get()
+
+    def start_trace(self, name: str, **attributes) -> Optional[Span]:
+        """Start root span of a new trace if it is sampled"""
+        if self._exporter is None or random.random() >= self._sample_rate:
+            return None
+        return Span(os.urandom(16).hex(), None, name, attributes)
+
+    def finish(self, span: Span):
+        span.ended_at = time.time_ns()
+        if self._exporter is not None:
+            self._exporter.add(span)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """Measure operation in child span of the current one"""
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(parent.trace_id, parent.span_id, name, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException:
+            span.is_error = True
+            raise
+        finally:
+            _current_span.reset(token)
+            self.finish(span)
+
+    @contextmanager
+    def activate(self, span: Optional[Span]) -> Iterator[None]:
+        """Make span current, so operations run in another task are traced as its children"""
+        token = _current_span.set(span)
+        try:
+            yield
+        finally:
+            _current_span.reset(token)
+
+
+tracer = Tracer()
+
+
+class TracedBot(Bot):
+    """Bot tracing every Telegram Bot API request"""
+
+    async def request(self, method: str, data: Optional[dict] = None, files: Optional[dict] = None, **kwargs):
+        with tracer.span(f'telegram {method}', method=method):
+            return await super(TracedBot, self).request(method, data, files, **kwargs)
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Trace sampled updates from receiving till all their changes are saved"""
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        span = tracer.start_trace('update', update_id=update.update_id, user_id=get_update_user_id(update) or 0)
+        if span is not None:
+            data['trace_span'], data['trace_token'] = span, _current_span.set(span)
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        if 'trace_span' in data:
+            _current_span.reset(data['trace_token'])
+            tracer.finish(data['trace_span'])
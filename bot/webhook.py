@@ -0,0 +1,104 @@
+import asyncio
+import hmac
+from typing import Callable, Awaitable
+
+import ujson
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from loguru import logger
+
+from bot.tenants import TenantRegistry, get_tenant_name
+from project_settings import settings
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+async def process_webhook_request(request: web.Request) -> web.Response:
+    """Check secret token of webhook request and pass received update to dispatcher of bot it is sent to"""
+    if not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ''), request.app['secret_token']):
+        raise web.HTTPForbidden()
+    dispatcher = request.app['tenants'].get(request.match_info.get('tenant', ''))
+    if dispatcher is None:
+        raise web.HTTPNotFound()
+
+    update = types.Update(**await request.json(loads=ujson.loads))
+    task = asyncio.create_task(_process_update(dispatcher, update))
+    updates_in_process: set[asyncio.Task] = request.app['updates_in_process']
+    updates_in_process.add(task)
+    task.add_done_callback(updates_in_process.discard)
+    return web.Response()
+
+
+async def _process_update(dispatcher: Dispatcher, update: types.Update):
+    """Process update in the same context dispatcher has while polling"""
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    try:
+        await dispatcher.process_updates([update])
+    except Exception:
+        logger.exception('Cause exception while processing update {update_id}', update_id=update.update_id)
+
+
+def get_webhook_path(tenant: str) -> str:
+    """Updates of the main bot are received on webhook path, updates of tenants on its sub paths"""
+    return f'{settings.webhook.path}/{tenant}' if tenant else settings.webhook.path
+
+
+def check_webhook_settings():
+    """Webhook mode requires public url of the bot and secret token, without it anyone knowing the url
+    could send forged updates on behalf of any user"""
+    if not settings.webhook.url:
+        raise ValueError('webhook.url has to be set to run the bot in webhook mode')
+    if not settings.webhook.secret_token:
+        raise ValueError('webhook.secret_token has to be set to run the bot in webhook mode')
+
+
+def create_webhook_app(
+        tenants: TenantRegistry,
+        on_startup: Callable[[list[Dispatcher]], Awaitable],
+        on_shutdown: Callable[[list[Dispatcher]], Awaitable],
+) -> web.Application:
+    """Create aiohttp application receiving telegram updates of all bots"""
+    check_webhook_settings()
+    app = web.Application()
+    app['tenants'] = tenants
+    app['secret_token'] = settings.webhook.secret_token
+    app['updates_in_process'] = set()
+    app.router.add_post(settings.webhook.path, process_webhook_request)
+    if len(tenants) > 1:
+        app.router.add_post(get_webhook_path('{tenant}'), process_webhook_request)
+    dispatchers = list(tenants)
+
+    async def startup(_: web.Application):
+        await on_startup(dispatchers)
+        for dispatcher in dispatchers:
+            webhook_params = dict(
+                url=settings.webhook.url + get_webhook_path(get_tenant_name(dispatcher)),
+                secret_token=settings.webhook.secret_token,
+                max_connections=settings.webhook.max_connections,
+            )  # Pending updates are kept, so updates sent during restart are processed
+            await dispatcher.bot.request('setWebhook', webhook_params)
+
+    async def shutdown(_: web.Application):
+        if app['updates_in_process']:
+            await asyncio.wait(app['updates_in_process'], timeout=settings.webhook.shutdown_timeout)
+        await on_shutdown(dispatchers)
+        for dispatcher in dispatchers:
+            await dispatcher.bot.close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    return app
+
+
+def start_webhook(
+        tenants: TenantRegistry,
+        on_startup: Callable[[list[Dispatcher]], Awaitable],
+        on_shutdown: Callable[[list[Dispatcher]], Awaitable],
+):
+    """Start all bots in webhook mode"""
+    web.run_app(
+        create_webhook_app(tenants, on_startup, on_shutdown),
+        host=settings.webhook.host,
+        port=settings.webhook.port,
+    )
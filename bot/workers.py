@@ -0,0 +1,140 @@
+import asyncio
+from typing import Callable, Awaitable, Optional
+
+import ujson
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aioredis.exceptions import ResponseError
+from loguru import logger
+
+from project_settings import settings
+
+UPDATES_STREAM_PREFIX = 'updates'
+WORKERS_GROUP = 'workers'
+WORKER_PARTITION_KEY = 'worker_partition'
+
+
+def get_update_user_id(update: types.Update) -> Optional[int]:
+    """Get id of user who has sent the update"""
+    for event in update.values.values():
+        from_user = getattr(event, 'from_user', None)
+        if from_user is not None:
+            return from_user.id
+    return None
+
+
+class UserLocks:
+    """Locks letting updates of one user be processed one by one,
+    lock of user is dropped when no update holds or waits for it"""
+
+    def __init__(self):
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._updates: dict[int, int] = {}  # Number of updates of user holding and waiting for the lock
+
+    async def acquire(self, user_id: int):
+        self._updates[user_id] = self._updates.get(user_id, 0) + 1
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        try:
+            await lock.acquire()
+        except asyncio.CancelledError:
+            self._forget(user_id)
+            raise
+
+    def release(self, user_id: int):
+        self._locks[user_id].release()
+        self._forget(user_id)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def _forget(self, user_id: int):
+        self._updates[user_id] -= 1
+        if not self._updates[user_id]:
+            del self._updates[user_id]
+            del self._locks[user_id]
+
+
+def get_update_partition(update: types.Update, partitions: int) -> int:
+    """Get partition of the update, all updates of one user always get into the same partition"""
+    user_id = get_update_user_id(update)
+    return (user_id if user_id is not None else update.update_id) % partitions
+
+
+def get_updates_stream_key(partition: int) -> str:
+    return f'{UPDATES_STREAM_PREFIX}:{partition}'
+
+
+class UpdatesFanOutMiddleware(BaseMiddleware):
+    """Publish received updates to partitioned redis streams instead of processing them in place"""
+
+    def __init__(self, partitions: int, stream_max_length: int):
+        self._partitions = partitions
+        self._stream_max_length = stream_max_length
+        super(UpdatesFanOutMiddleware, self).__init__()
+
+    async def on_process_update(self, update: types.Update, data: dict):
+        redis = await self.manager.dispatcher.storage.redis()
+        await redis.xadd(
+            get_updates_stream_key(get_update_partition(update, self._partitions)),
+            {'update': ujson.dumps(update.to_python())},
+            maxlen=self._stream_max_length,
+            approximate=True,
+        )
+        data['is_update_published'] = True  # Update is released by worker processing it
+        raise CancelHandler()
+
+
+async def run_worker(dispatcher: Dispatcher, partition: int):
+    """Process updates of one partition one by one, so updates of every user are processed in order"""
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    redis = await dispatcher.storage.redis()
+    stream_key, consumer = get_updates_stream_key(partition), f'worker-{partition}'
+    try:
+        await redis.xgroup_create(stream_key, WORKERS_GROUP, id='0', mkstream=True)
+    except ResponseError as error:
+        if 'BUSYGROUP' not in str(error):
+            raise
+
+    logger.info('Worker {consumer} started', consumer=consumer)
+    last_id = '0'  # Process updates left unacknowledged by previous run first
+    while True:
+        entries = await redis.xreadgroup(
+            WORKERS_GROUP,
+            consumer,
+            {stream_key: last_id},
+            count=settings.workers.batch_size,
+            block=settings.workers.block_timeout,
+        )
+        messages = entries[0][1] if entries else []
+        if not messages and last_id != '>':
+            last_id = '>'
+            continue
+
+        for message_id, fields in messages:
+            update = types.Update(**ujson.loads(fields['update']))
+            try:
+                await dispatcher.process_updates([update])
+            except Exception:
+                logger.exception('Cause exception while processing update {update_id}', update_id=update.update_id)
+            await redis.xack(stream_key, WORKERS_GROUP, message_id)
+
+
+def start_worker(
+        dispatcher: Dispatcher,
+        partition: int,
+        on_startup: Callable[[Dispatcher], Awaitable],
+        on_shutdown: Callable[[Dispatcher], Awaitable],
+):
+    """Start worker processing updates of given partition"""
+    dispatcher[WORKER_PARTITION_KEY] = partition
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(on_startup(dispatcher))
+    try:
+        loop.run_until_complete(run_worker(dispatcher, partition))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        loop.run_until_complete(on_shutdown(dispatcher))
+        loop.run_until_complete(dispatcher.bot.close())
@@ -1,22 +1,214 @@
+import os
 import pathlib
+from typing import Any, Callable, Literal, Optional, cast
 
 import ujson
 from pydantic import BaseModel
 
 
+class ApiClientSettings(BaseModel):
+
+    base_url: str = 'https://front.kcash.ru'
+    connections_limit: int = 100
+    connections_limit_per_host: int = 30
+    keepalive_timeout: float = 30
+    dns_cache_ttl: int = 300
+    user_info_timeout: float = 10
+    token_refresh_ratio: float = 0.1
+    connect_timeout: float = 3
+    read_timeout: float = 10
+    retries: int = 2
+    retry_backoff: float = 0.2
+    failure_threshold: int = 5
+    recovery_timeout: float = 30
+
+
+class UserDataCacheSettings(BaseModel):
+
+    ttl: float = 30
+    max_size: int = 10000
+    use_redis: bool = False
+
+
+class WebhookSettings(BaseModel):
+
+    url: Optional[str] = None
+    path: str = '/webhook'
+    host: str = '0.0.0.0'
+    port: int = 8080
+    secret_token: Optional[str] = None
+    max_connections: int = 40
+    shutdown_timeout: float = 10
+
+
+class PollingSettings(BaseModel):
+
+    timeout: int = 20
+    drain_timeout: float = 10
+
+
+class DeduplicationSettings(BaseModel):
+
+    updates_cache_size: int = 10000
+    use_redis: bool = False
+    redis_ttl: int = 86400
+
+
+class AdmissionSettings(BaseModel):
+
+    enabled: bool = True
+    max_in_flight: int = 100
+    queue_size: int = 1000
+
+
+class WorkersSettings(BaseModel):
+
+    partitions: int = 0
+    stream_max_length: int = 100000
+    batch_size: int = 10
+    block_timeout: int = 5000
+    callback_in_flight_ttl: int = 60
+
+
+class StorageSettings(BaseModel):
+
+    backend: Literal['json', 'hash', 'memory'] = 'json'
+    shards: int = 16
+    max_sessions: int = 100000
+    flush_interval: float = 1
+    flush_batch_size: int = 500
+
+
+class SessionsSettings(BaseModel):
+
+    data_submission_ttl: int = 1800
+    authorized_ttl: int = 604800
+    idle_ttl: int = 86400
+    sweeper_enabled: bool = False
+    sweep_interval: float = 3600
+    sweep_batch_size: int = 500
+
+
+class SenderSettings(BaseModel):
+
+    global_rate: float = 30
+    chat_rate: float = 1
+    chat_burst: float = 3
+    shutdown_timeout: float = 5
+
+
+class BalanceRefresherSettings(BaseModel):
+
+    enabled: bool = False
+    interval: float = 60
+    concurrency: int = 5
+    batch_size: int = 100
+
+
+class MetricsSettings(BaseModel):
+
+    enabled: bool = False
+    host: str = '127.0.0.1'
+    port: int = 9100
+
+
+class TracingSettings(BaseModel):
+
+    enabled: bool = False
+    sample_rate: float = 0.1
+    destination: str = 'traces.jsonl'
+    batch_size: int = 512
+    flush_interval: float = 5
+    max_queue_size: int = 10000
+    service_name: str = 'kcash-tg-bot'
+
+
+class TenantSettings(BaseModel):
+
+    name: str
+    token: str
+
+
+class LoggingSettings(BaseModel):
+
+    level: str = 'DEBUG'
+    structured: bool = False
+    sink: Optional[str] = None
+    batch_size: int = 100
+    flush_interval: float = 1
+    sampling: dict[str, float] = {}
+
+
 class ProjectSettings(BaseModel):
 
     telegram_token: str
     redis_password: str
+    redis_host: str = 'bots_redis'
+    telegram_api_url: Optional[str] = None
+    run_mode: Literal['polling', 'webhook'] = 'polling'
+    storage: StorageSettings = StorageSettings()
+    sessions: SessionsSettings = SessionsSettings()
+    api_client: ApiClientSettings = ApiClientSettings()
+    user_data_cache: UserDataCacheSettings = UserDataCacheSettings()
+    polling: PollingSettings = PollingSettings()
+    webhook: WebhookSettings = WebhookSettings()
+    deduplication: DeduplicationSettings = DeduplicationSettings()
+    admission: AdmissionSettings = AdmissionSettings()
+    workers: WorkersSettings = WorkersSettings()
+    sender: SenderSettings = SenderSettings()
+    balance_refresher: BalanceRefresherSettings = BalanceRefresherSettings()
+    metrics: MetricsSettings = MetricsSettings()
+    tracing: TracingSettings = TracingSettings()
+    logging: LoggingSettings = LoggingSettings()
+    tenants: list[TenantSettings] = []
 
     @classmethod
-    def load_project_settings_from_json_file(cls, config_path: pathlib.Path) -> 'ProjectSettings':
-        """load required project settings from config.json with given path"""
-        config = ujson.load(config_path.open('r'))
+    def load_project_settings_from_config(cls, config: dict[str, Any]) -> 'ProjectSettings':
         return cls(
             telegram_token=config.get('token'),
             redis_password=config.get('redis_password'),
+            redis_host=config.get('redis_host', 'bots_redis'),
+            telegram_api_url=config.get('telegram_api_url'),
+            run_mode=config.get('run_mode', 'polling'),
+            storage=config.get('storage', {}),
+            sessions=config.get('sessions', {}),
+            api_client=config.get('api_client', {}),
+            user_data_cache=config.get('user_data_cache', {}),
+            polling=config.get('polling', {}),
+            webhook=config.get('webhook', {}),
+            deduplication=config.get('deduplication', {}),
+            admission=config.get('admission', {}),
+            workers=config.get('workers', {}),
+            sender=config.get('sender', {}),
+            balance_refresher=config.get('balance_refresher', {}),
+            metrics=config.get('metrics', {}),
+            tracing=config.get('tracing', {}),
+            logging=config.get('logging', {}),
+            tenants=config.get('tenants', []),
         )
 
 
-settings = ProjectSettings.load_project_settings_from_json_file(pathlib.Path('config.json'))
+class LazySettings:
+    """Settings loaded on first access, so importing modules using them does not require config"""
+
+    def __init__(self, loader: Callable[[], ProjectSettings]):
+        self._loader = loader
+        self._settings: Optional[ProjectSettings] = None
+
+    def __getattr__(self, name: str) -> Any:
+        if self._settings is None:
+            self._settings = self._loader()
+        return getattr(self._settings, name)
+
+
+def load_project_settings() -> ProjectSettings:
+    """Load settings from json file set in BOT_CONFIG_PATH env variable or config.json if it exists,
+    telegram token and redis password may be set in TELEGRAM_TOKEN and REDIS_PASSWORD env variables instead"""
+    config_path = pathlib.Path(os.environ.get('BOT_CONFIG_PATH', 'config.json'))
+    config = ujson.load(config_path.open('r')) if 'BOT_CONFIG_PATH' in os.environ or config_path.exists() else {}
+    config['token'] = os.environ.get('TELEGRAM_TOKEN', config.get('token'))
+    config['redis_password'] = os.environ.get('REDIS_PASSWORD', config.get('redis_password'))
+    return ProjectSettings.load_project_settings_from_config(config)
+
+
+settings = cast(ProjectSettings, LazySettings(load_project_settings))
@@ -0,0 +1,33 @@
+import os
+from typing import Awaitable, Callable
+
+import pytest_asyncio
+
+# Settings are loaded on first use, tests run with defaults without config file
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:test')
+os.environ.setdefault('REDIS_PASSWORD', '')
+
+from benchmarks.load_test import use_fakeredis  # noqa: E402
+from bot.storage import BufferedRedisStorage  # noqa: E402
+
+StorageFactory = Callable[..., Awaitable[BufferedRedisStorage]]
+
+
+@pytest_asyncio.fixture
+async def create_storage() -> StorageFactory:
+    """Create FSM storages backed by one in-process fakeredis, storages are closed after the test"""
+    storages: list[BufferedRedisStorage] = []
+
+    async def create(storage_class: type = BufferedRedisStorage, **kwargs) -> BufferedRedisStorage:
+        if storages:  # Storages created after the first one share its fakeredis
+            kwargs.setdefault('pool_owner', storages[0])
+        storage = storage_class(**kwargs)
+        if not storages:
+            await use_fakeredis(storage)
+        storages.append(storage)
+        return storage
+
+    yield create
+    for storage in reversed(storages):
+        await storage.close()
+        await storage.wait_closed()
@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher
+
+from bot.balance_refresher import BalanceRefresher
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_round_longer_than_interval_is_not_overlapped_by_another_process(create_storage):
+    rounds = []
+
+    async def refresh_round(dispatcher: Dispatcher):
+        rounds.append(dispatcher)
+        await asyncio.sleep(1.5)
+
+    refreshers = [BalanceRefresher(), BalanceRefresher()]  # Refreshers of two bot processes
+    for refresher in refreshers:
+        refresher._refresh_round = refresh_round
+        await refresher.start(Dispatcher(Bot('123456:test'), storage=await create_storage()), 1, 1, 10)
+    await asyncio.sleep(1.8)
+    for refresher in refreshers:
+        await refresher.close()
+    assert len(rounds) == 1
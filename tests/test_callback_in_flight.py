@@ -0,0 +1,94 @@
+import pytest
+import pytest_asyncio
+import ujson
+from aiogram import Bot, Dispatcher, types
+
+from bot.deduplication import CallbackInFlightMiddleware
+from bot.workers import UpdatesFanOutMiddleware
+
+pytestmark = pytest.mark.asyncio
+
+
+class SilentBot(Bot):
+    """Bot answering every Bot API request without sending it"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        return True
+
+
+def create_press_update(update_id: int) -> types.Update:
+    user = {'id': 1, 'is_bot': False, 'first_name': 'user'}
+    return types.Update(**{'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user, 'chat_instance': '1', 'data': 'enable_2fa',
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': ''},
+    }})
+
+
+@pytest.fixture
+def published() -> list[str]:
+    """Updates published by intake process to workers"""
+    return []
+
+
+@pytest.fixture
+def processed() -> list[str]:
+    """Ids of callback queries processed by worker"""
+    return []
+
+
+@pytest_asyncio.fixture
+async def intake(create_storage, published) -> Dispatcher:
+    dispatcher = Dispatcher(SilentBot('123456:test'), storage=await create_storage())
+    dispatcher.middleware.setup(CallbackInFlightMiddleware(redis_ttl=60))
+    dispatcher.middleware.setup(UpdatesFanOutMiddleware(partitions=1, stream_max_length=100))
+
+    async def xadd(stream_key: str, fields: dict, **kwargs):  # Streams are not supported by fakeredis
+        published.append(fields['update'])
+
+    (await dispatcher.storage.redis()).xadd = xadd
+    return dispatcher
+
+
+@pytest_asyncio.fixture
+async def worker(create_storage, intake, processed) -> Dispatcher:
+    dispatcher = Dispatcher(SilentBot('123456:test'), storage=await create_storage())
+    dispatcher.middleware.setup(CallbackInFlightMiddleware(redis_ttl=60, is_worker=True))
+
+    async def enable_2fa(callback_query: types.CallbackQuery):
+        processed.append(callback_query.id)
+
+    dispatcher.register_callback_query_handler(enable_2fa)
+    return dispatcher
+
+
+async def press(intake: Dispatcher, update_id: int):
+    Bot.set_current(intake.bot)  # Press in flight is answered with toast
+    await intake.process_updates([create_press_update(update_id)])
+
+
+async def process_published(worker: Dispatcher, published: list[str]):
+    await worker.process_updates([types.Update(**ujson.loads(published.pop(0)))])
+
+
+async def test_press_is_published_to_worker(intake, published):
+    await press(intake, 1)
+    assert len(published) == 1
+
+
+async def test_press_published_to_worker_stays_in_flight(intake, published):
+    await press(intake, 1)
+    await press(intake, 2)  # Pressed again before worker has processed it
+    assert len(published) == 1
+
+
+async def test_worker_processes_published_press(intake, worker, published, processed):
+    await press(intake, 1)
+    await process_published(worker, published)
+    assert processed == ['1']
+
+
+async def test_press_is_released_after_worker_processed_it(intake, worker, published):
+    await press(intake, 1)
+    await process_published(worker, published)
+    await press(intake, 2)
+    assert len(published) == 1
@@ -0,0 +1,115 @@
+import pytest
+import pytest_asyncio
+from aiogram.dispatcher import FSMContext
+
+from bot.constants import SIGN_IN_DATA, Codes
+from bot.flows import FLOWS, FlowStep, compile_flow, start_flow, submit_flow_step
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest_asyncio.fixture
+async def state(create_storage) -> FSMContext:
+    return FSMContext(await create_storage(), chat=1, user=1)
+
+
+@pytest.mark.parametrize('code, expected_steps', [
+    pytest.param(Codes.SIGN_IN_USER.value, [
+        FlowStep('login', False, 'Type your password'),
+        FlowStep('password', False, 'Type your capcha'),
+        FlowStep('capcha', True, None),
+        FlowStep('twoFaPin', True, None),
+        FlowStep(None, True, None),
+    ], id='sign_in'),
+    pytest.param(Codes.REGISTER_USER.value, [
+        FlowStep('email', False, 'Type your password'),
+        FlowStep('password', False, 'Type your userName'),
+        FlowStep('userName', False, 'Type your capcha'),
+        FlowStep('capcha', True, None),
+        FlowStep(None, True, None),
+    ], id='sign_up'),
+    pytest.param(Codes.PASSWORD_CHANGE.value, [
+        FlowStep('email', False, 'Type your currentPassword'),
+        FlowStep('currentPassword', False, 'Type your newPassword'),
+        FlowStep('newPassword', True, None),
+        FlowStep('twoFaPin', True, None),
+        FlowStep(None, True, None),
+    ], id='password_change'),
+])
+def test_flow_steps_are_in_fields_order(code, expected_steps):
+    assert list(FLOWS[code].steps) == expected_steps
+
+
+@pytest.mark.parametrize('submit_from, expected_submits', [
+    (0, [True, True, True, True]),
+    (1, [False, True, True, True]),
+    (2, [False, False, True, True]),
+])
+def test_data_is_submitted_from_given_field(submit_from, expected_submits):
+    flow = compile_flow('code', ('first', 'second', 'third'), submit_from=submit_from)
+    assert [step.submit for step in flow.steps] == expected_submits
+
+
+@pytest.mark.parametrize('step, expected_step', [
+    (0, FlowStep('first', False, 'Type your second')),
+    (1, FlowStep('second', True, None)),
+    (2, FlowStep(None, True, None)),
+    (10, FlowStep(None, True, None)),
+])
+def test_steps_after_the_last_one_only_submit_data(step, expected_step):
+    assert compile_flow('code', ('first', 'second'), submit_from=1).get_step(step) == expected_step
+
+
+@pytest.mark.parametrize('code, expected_user_info_fields', [
+    (Codes.SIGN_IN_USER.value, ('login', 'password', 'capcha', 'twoFaPin')),
+    (Codes.REGISTER_USER.value, ('email', 'password', 'login', 'capcha')),
+    (Codes.PASSWORD_CHANGE.value, ('email', 'currentPassword', 'newPassword', 'twoFaPin')),
+])
+async def test_flow_starts_with_empty_user_info(state, code, expected_user_info_fields):
+    await start_flow(state, code)
+    assert await state.get_data() == {
+        'flow': code,
+        'step': 0,
+        'user_info': dict.fromkeys(expected_user_info_fields, ''),
+    }
+
+
+@pytest.mark.parametrize('texts, expected_step, expected_user_info', [
+    (['user'], 1, {'login': 'user', 'password': '', 'capcha': '', 'twoFaPin': ''}),
+    (['user', 'secret', 'capcha'], 3, {'login': 'user', 'password': 'secret', 'capcha': 'capcha', 'twoFaPin': ''}),
+    (['user', 'secret', 'capcha', '123456'], 4, {
+        'login': 'user', 'password': 'secret', 'capcha': 'capcha', 'twoFaPin': '123456',
+    }),
+    (['user', 'secret', 'capcha', '123456', 'again'], 5, {
+        'login': 'user', 'password': 'secret', 'capcha': 'capcha', 'twoFaPin': '123456',
+    }),
+])
+async def test_submitted_texts_fill_user_info(state, texts, expected_step, expected_user_info):
+    await start_flow(state, Codes.SIGN_IN_USER.value)
+    for text in texts:
+        await submit_flow_step(state, text)
+    data = await state.get_data()
+    assert data['step'] == expected_step
+    assert data['user_info'] == expected_user_info
+
+
+@pytest.mark.parametrize('submitted_steps, expected_submit', [(0, False), (1, False), (2, True), (3, True)])
+async def test_submission_step_is_returned(state, submitted_steps, expected_submit):
+    await start_flow(state, Codes.SIGN_IN_USER.value)
+    for _ in range(submitted_steps):
+        await submit_flow_step(state, 'text')
+    flow, step = await submit_flow_step(state, 'text')
+    assert flow is FLOWS[Codes.SIGN_IN_USER.value]
+    assert step.submit is expected_submit
+
+
+@pytest.mark.parametrize('current_index, expected_field', [(0, 'login'), (2, 'capcha'), (3, 'twoFaPin')])
+async def test_legacy_current_task_is_migrated(state, current_index, expected_field):
+    user_info = dict.fromkeys(SIGN_IN_DATA, '')
+    current_task = {'type': Codes.SIGN_IN_USER.value, 'current_index': current_index, 'required_data': SIGN_IN_DATA}
+    await state.set_data({'current_task': current_task, 'user_info': user_info})
+    _, step = await submit_flow_step(state, 'text')
+    data = await state.get_data()
+    assert step.field == expected_field
+    assert (data['flow'], data['step']) == (Codes.SIGN_IN_USER.value, current_index + 1)
+    assert data['user_info'] == {**user_info, expected_field: 'text'}
@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+from bot.locks import RedisLock
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_lock_is_taken_by_one_process(create_storage):
+    redis = await (await create_storage()).redis()
+    async with RedisLock(redis, 'job:lock', ttl=1).hold() as is_taken:
+        async with RedisLock(redis, 'job:lock', ttl=1).hold() as is_taken_again:
+            assert is_taken
+            assert not is_taken_again
+
+
+async def test_lock_is_extended_while_held(create_storage):
+    redis = await (await create_storage()).redis()
+    async with RedisLock(redis, 'job:lock', ttl=1).hold():
+        await asyncio.sleep(1.5)
+        assert await redis.exists('job:lock')
+
+
+async def test_lock_is_kept_till_ttl_after_job(create_storage):
+    redis = await (await create_storage()).redis()
+    async with RedisLock(redis, 'job:lock', ttl=1).hold():
+        pass
+    assert 0 < await redis.ttl('job:lock') <= 1
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from bot.storage import BufferedRedisStorage, MemoryRedisStorage
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_session_loaded_concurrently_is_not_lost_on_eviction(create_storage):
+    storage = await create_storage(MemoryRedisStorage, shards=1, max_sessions=1)
+    await asyncio.gather(storage.set_state(chat=1, user=1, state='A'), storage.get_state(chat=2, user=2))
+    await storage.flush_sessions()
+    assert await (await create_storage()).get_state(chat=1, user=1) == 'A'
+
+
+async def test_changed_session_is_kept_in_memory_until_written(create_storage):
+    storage = await create_storage(MemoryRedisStorage, shards=1, max_sessions=1)
+    await storage.set_state(chat=1, user=1, state='A')
+    await storage.get_state(chat=2, user=2)
+    assert ('1', '1') in storage._shards[0].records
+
+
+async def test_written_session_is_evicted(create_storage):
+    storage = await create_storage(MemoryRedisStorage, shards=1, max_sessions=1)
+    await storage.set_state(chat=1, user=1, state='A')
+    await storage.flush_sessions()
+    await storage.get_state(chat=2, user=2)
+    assert ('1', '1') not in storage._shards[0].records
+
+
+async def test_flush_skips_sessions_missing_in_memory(create_storage):
+    storage = await create_storage(MemoryRedisStorage, shards=1)
+    await storage.set_state(chat=1, user=1, state='A')
+    storage._shards[0].dirty.add(('2', '2'))
+    await storage.flush_sessions()
+    assert await (await storage.redis()).get('fsm:1:1:state') == 'A'
+
+
+async def test_changes_are_not_written_at_once(create_storage):
+    storage = await create_storage(MemoryRedisStorage, flush_interval=10)
+    await storage.set_state(chat=1, user=1, state='A')
+    assert await (await storage.redis()).get('fsm:1:1:state') is None
+
+
+async def test_changes_are_written_behind(create_storage):
+    storage = await create_storage(MemoryRedisStorage, flush_interval=0.01)
+    await storage.set_state(chat=1, user=1, state='A')
+    await storage.update_data(chat=1, user=1, data={'email': 'user@example.com'})
+    await asyncio.sleep(0.05)
+    reader = await create_storage(BufferedRedisStorage)
+    assert await reader.get_state(chat=1, user=1) == 'A'
+    assert await reader.get_data(chat=1, user=1) == {'email': 'user@example.com'}
+
+
+async def test_close_writes_batch_held_by_writer(create_storage):
+    storage = await create_storage(MemoryRedisStorage, flush_interval=0.01)
+    write_records, writing = storage._write_records, asyncio.Event()
+
+    async def stalled_write(records):
+        if not writing.is_set():
+            writing.set()
+            await asyncio.sleep(10)
+        await write_records(records)
+
+    storage._write_records = stalled_write
+    await storage.set_state(chat=1, user=1, state='A')
+    await writing.wait()
+    await storage.close()
+    assert await (await create_storage()).get_state(chat=1, user=1) == 'A'
+
+
+async def test_read_session_expiry_is_reset_on_flush(create_storage):
+    storage = await create_storage(MemoryRedisStorage, shards=1, default_session_ttl=100)
+    await storage.set_data(chat=1, user=1, data={'key': 'value'})
+    await storage.flush_sessions()
+    redis = await storage.redis()
+    await redis.expire('fsm:1:1:data', 10)
+    await storage.get_data(chat=1, user=1)
+    await storage.flush_sessions()
+    assert await redis.ttl('fsm:1:1:data') == 100
+
+
+async def test_read_session_expiry_is_not_reset_at_once(create_storage):
+    storage = await create_storage(MemoryRedisStorage, shards=1, default_session_ttl=100)
+    await storage.set_data(chat=1, user=1, data={'key': 'value'})
+    await storage.flush_sessions()
+    redis = await storage.redis()
+    await redis.expire('fsm:1:1:data', 10)
+    await storage.get_data(chat=1, user=1)
+    assert await redis.ttl('fsm:1:1:data') == 10
@@ -0,0 +1,68 @@
+import aiohttp
+import pytest
+from aiogram import Bot, Dispatcher
+
+from bot.app import get_metrics_port
+from bot.cache import UserDataCache
+from bot.metrics import Gauge, MetricsRegistry, registry
+from bot.workers import WORKER_PARTITION_KEY
+from project_settings import settings
+
+pytestmark = pytest.mark.asyncio
+
+METRICS_PORT = 19100
+
+
+@pytest.fixture
+def metrics_enabled(monkeypatch):
+    monkeypatch.setattr(settings.metrics, 'enabled', True)
+    monkeypatch.setattr(settings.metrics, 'port', METRICS_PORT)
+
+
+def create_worker_dispatcher(partition: int) -> Dispatcher:
+    dispatcher = Dispatcher(Bot('123456:test'))
+    dispatcher[WORKER_PARTITION_KEY] = partition
+    return dispatcher
+
+
+async def get_metrics(port: int) -> str:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f'http://{settings.metrics.host}:{port}/metrics') as response:
+            return await response.text()
+
+
+async def test_workers_serve_metrics_on_own_ports(metrics_enabled):
+    registries = []  # Every worker is a separate process with its own registry
+    try:
+        for partition in (0, 1):
+            worker_registry = MetricsRegistry()
+            worker_registry.register(Gauge('bot_worker_partition', 'Worker partition', lambda value=partition: value))
+            await worker_registry.start_server(
+                settings.metrics.host,
+                get_metrics_port(create_worker_dispatcher(partition)),
+            )
+            registries.append(worker_registry)
+        assert 'bot_worker_partition 0' in await get_metrics(METRICS_PORT + 1)
+        assert 'bot_worker_partition 1' in await get_metrics(METRICS_PORT + 2)
+    finally:
+        for worker_registry in registries:
+            await worker_registry.stop_server()
+
+
+async def test_intake_process_serves_metrics_on_configured_port(metrics_enabled):
+    assert get_metrics_port(Dispatcher(Bot('123456:test'))) == METRICS_PORT
+
+
+def test_metric_registered_again_is_exposed_once():
+    metrics_registry = MetricsRegistry()
+    metrics_registry.register(Gauge('bot_updates_waiting_admission', 'Updates waiting for their turn', lambda: 1))
+    metrics_registry.register(Gauge('bot_updates_waiting_admission', 'Updates waiting for their turn', lambda: 2))
+    assert metrics_registry.expose().count('# TYPE bot_updates_waiting_admission') == 1
+    assert 'bot_updates_waiting_admission 2' in metrics_registry.expose()
+
+
+async def test_user_data_cache_misses_are_counted(metrics_enabled):
+    cache = UserDataCache()
+    await cache.get(1)
+    assert 'bot_user_data_cache_misses_total 1' in registry.expose()
+    assert '# TYPE bot_user_data_cache_hits_total counter' in registry.expose()
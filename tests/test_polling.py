@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+from aiogram import Bot, Dispatcher, types
+
+from bot.polling import POLLING_OFFSET_KEY, GracefulPolling
+
+pytestmark = pytest.mark.asyncio
+
+SLOW_TEXT = 'slow'
+
+
+def create_message_update(update_id: int, text: str = 'text') -> types.Update:
+    user = {'id': update_id, 'is_bot': False, 'first_name': 'user'}
+    return types.Update(**{'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'chat': {'id': update_id, 'type': 'private'}, 'from': user, 'text': text,
+    }})
+
+
+class FakeBot(Bot):
+    """Bot getting given update batches one by one and then waiting for updates forever"""
+
+    def __init__(self, batches: list[list[types.Update]]):
+        self.batches = batches
+        super(FakeBot, self).__init__('123456:test')
+
+    async def delete_webhook(self, *args, **kwargs) -> bool:
+        return True
+
+    async def get_updates(self, offset=None, *args, **kwargs) -> list[types.Update]:
+        if self.batches:
+            return self.batches.pop(0)
+        await asyncio.sleep(3600)
+
+
+@pytest_asyncio.fixture
+async def create_polling(create_storage):
+    async def create(batches: list[list[types.Update]]) -> GracefulPolling:
+        dispatcher = Dispatcher(FakeBot(batches), storage=await create_storage())
+
+        async def process_message(message: types.Message):
+            if message.text == SLOW_TEXT:
+                await asyncio.sleep(3600)
+
+        dispatcher.register_message_handler(process_message)
+        await (await dispatcher.storage.redis()).set(POLLING_OFFSET_KEY, 1)
+        return GracefulPolling(dispatcher, timeout=1)
+
+    return create
+
+
+async def poll_and_drain(polling: GracefulPolling) -> int:
+    """Poll all batches, stop polling like on shutdown and get the saved offset"""
+    polling_task = asyncio.create_task(polling.run())
+    await asyncio.sleep(0.05)
+    polling_task.cancel()
+    await asyncio.gather(polling_task, return_exceptions=True)
+    await polling.drain(timeout=0.05)
+    return int(await (await polling._dispatcher.storage.redis()).get(POLLING_OFFSET_KEY))
+
+
+@pytest.mark.parametrize('batches, expected_offset', [
+    pytest.param([[create_message_update(1), create_message_update(2)]], 3, id='processed'),
+    pytest.param([[create_message_update(1)], [create_message_update(2, SLOW_TEXT)]], 2, id='last_cancelled'),
+    pytest.param(
+        [[create_message_update(1, SLOW_TEXT)], [create_message_update(2)], [create_message_update(3, SLOW_TEXT)]],
+        1,
+        id='first_cancelled',
+    ),
+    pytest.param(
+        [[create_message_update(1)], [create_message_update(2), create_message_update(3, SLOW_TEXT)]],
+        2,
+        id='batch_partly_processed',
+    ),
+])
+async def test_offset_saved_on_drain(create_polling, batches, expected_offset):
+    assert await poll_and_drain(await create_polling(batches)) == expected_offset
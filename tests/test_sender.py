@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from bot.sender import MessageSender
+
+pytestmark = pytest.mark.asyncio
+
+
+class FlakyBot:
+    """Bot failing to send the first message with error not wrapped by aiogram"""
+
+    def __init__(self):
+        self.sent_texts = []
+        self.failures = 0
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None):
+        if not self.failures:
+            self.failures += 1
+            raise asyncio.TimeoutError()
+        self.sent_texts.append(text)
+
+
+@pytest.fixture
+def bot() -> FlakyBot:
+    return FlakyBot()
+
+
+@pytest_asyncio.fixture
+async def sender(bot: FlakyBot) -> MessageSender:
+    sender = MessageSender()
+    await sender.start(bot, global_rate=100, chat_rate=100, chat_burst=100)
+    yield sender
+    await sender.close(timeout=1)
+
+
+async def send_and_wait(sender: MessageSender, text: str):
+    await sender.send(1, text)
+    await asyncio.sleep(0.05)
+
+
+async def test_chat_keeps_sending_after_failed_send(sender, bot):
+    await send_and_wait(sender, 'first')
+    await send_and_wait(sender, 'second')
+    await send_and_wait(sender, 'third')
+    assert bot.sent_texts == ['second', 'third']
+
+
+async def test_failed_message_leaves_queue(sender, bot):
+    await send_and_wait(sender, 'first')
+    assert bot.failures == 1
+    assert sender.queue_size() == 0
@@ -0,0 +1,33 @@
+import pytest
+from aiogram import Bot, Dispatcher
+
+from bot.sessions import SessionSweeper
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_tenant_keys_are_swept_with_tenant_storage(create_storage):
+    main_storage = await create_storage(prefix='fsm', default_session_ttl=100)
+    tenant_storage = await create_storage(prefix='fsm:tenant', default_session_ttl=200)
+    redis = await main_storage.redis()
+    await redis.mset({'fsm:1:1:state': 'state', 'fsm:tenant:1:1:state': 'state'})
+    sweeper = SessionSweeper()
+    for storage in (main_storage, tenant_storage):
+        await sweeper.start(Dispatcher(Bot('123456:test'), storage=storage), interval=3600, batch_size=100)
+    await sweeper.close()  # Sweep is run by the test only
+
+    assert await sweeper.sweep() == (0, 2)
+    assert await redis.ttl('fsm:1:1:state') == 100
+    assert await redis.ttl('fsm:tenant:1:1:state') == 200
+
+
+async def test_keys_of_users_without_state_are_deleted(create_storage):
+    storage = await create_storage(prefix='fsm')
+    redis = await storage.redis()
+    await redis.set('fsm:1:1:data', '{}')
+    sweeper = SessionSweeper()
+    await sweeper.start(Dispatcher(Bot('123456:test'), storage=storage), interval=3600, batch_size=100)
+    await sweeper.close()
+
+    assert await sweeper.sweep() == (1, 0)
+    assert not await redis.exists('fsm:1:1:data')
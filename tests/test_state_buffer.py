@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher, types
+
+from bot.storage import StateBufferMiddleware
+
+pytestmark = pytest.mark.asyncio
+
+
+def create_message_update(update_id: int, user_id: int, text: str) -> types.Update:
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'user'}
+    return types.Update(**{'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'from': user, 'text': text,
+    }})
+
+
+async def create_dispatcher(create_storage, serialize_users: bool) -> Dispatcher:
+    """Dispatcher saving text of every message as a field of user data, like data submission handlers do"""
+    dispatcher = Dispatcher(Bot('123456:test'), storage=await create_storage())
+    dispatcher.middleware.setup(StateBufferMiddleware(serialize_users=serialize_users))
+
+    async def submit_field(message: types.Message):
+        state = dispatcher.current_state()
+        data = await state.get_data()
+        await asyncio.sleep(0.01)  # Like kcash API call made while the update is processed
+        await state.set_data({**data, message.text: True})
+
+    dispatcher.register_message_handler(submit_field)
+    return dispatcher
+
+
+async def test_concurrent_updates_of_user_keep_all_changes(create_storage):
+    dispatcher = await create_dispatcher(create_storage, serialize_users=True)
+    await dispatcher.process_updates([create_message_update(1, 1, 'email'), create_message_update(2, 1, 'password')])
+    assert await dispatcher.storage.get_data(chat=1, user=1) == {'email': True, 'password': True}
+
+
+async def test_updates_of_different_users_are_processed_concurrently(create_storage):
+    dispatcher = await create_dispatcher(create_storage, serialize_users=True)
+    updates = [create_message_update(update_id, update_id, 'email') for update_id in range(1, 11)]
+    started_at = asyncio.get_running_loop().time()
+    await dispatcher.process_updates(updates)
+    assert asyncio.get_running_loop().time() - started_at < 0.05